@@ -0,0 +1,35 @@
+"""per-request cost of `Bearer` authentication, decoding every token vs. the verified-token cache
+
+    python -m bench.auth
+"""
+
+from core.common.auth import Bearer, verified_tokens, sk_1
+from argparse import ArgumentParser
+from timeit import timeit
+import jwt
+
+
+def bench(number: int, users: int):
+    tokens = [f"Bearer {jwt.encode({'id': f'user-{i}'}, sk_1, 'HS256')}" for i in range(users)]
+
+    def cold():
+        for token in tokens:
+            verified_tokens.clear()
+            Bearer(token, None, None)
+
+    def warm():
+        for token in tokens:
+            Bearer(token, None, None)
+
+    warm()
+    print(f"{'':<8} {'us/request':>10}")
+    for name, run in (("decode", cold), ("cached", warm)):
+        print(f"{name:<8} {timeit(run, number=number) * 1e6 / number / users:>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--number", type=int, default=2000, help="rounds over all tokens")
+    parser.add_argument("-u", "--users", type=int, default=50, help="distinct tokens")
+    args = parser.parse_args()
+    bench(args.number, args.users)
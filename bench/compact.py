@@ -0,0 +1,58 @@
+"""size and serialization time of prettified vs. compact html bodies, over the fixtures of `bench.parsers`
+
+articles are stored unprettified and re-parsed when served, so their timings include that parse,
+`same` tells whether this served output equals serializing the scraped tag directly
+
+    python -m bench.parsers --record  # once
+    python -m bench.compact
+"""
+
+from .parsers import page_types, fixture_path
+from core.info.homes import resthome_strainer
+from core.info.news import article_strainer
+from core.info.compact import compact_html
+from argparse import ArgumentParser
+from bs4 import BeautifulSoup, Tag
+from timeit import timeit
+
+
+def stored(tag: Tag):
+    return BeautifulSoup(str(tag), "html.parser")  # what `formatted` parses (uncached) from the article store
+
+
+bodies = {
+    # page type: (strainer, selectors of the html fields, what's rendered when served)
+    "article": (article_strainer, ["div.news-content"], stored),
+    "resthome": (resthome_strainer, ["div.inst-charge > div.cont", "div.facilities > div.cont",
+                                     "div.service-content > div.cont", "div.inst-notes > div.cont",
+                                     "div.inst-intro > div.cont"], lambda tag: tag),
+}
+
+
+def bench(number: int):
+    print(f"{'page type':<10} {'fields':>6} {'pretty B':>9} {'compact B':>9} {'ratio':>6} {'pretty ms':>9}"
+          f" {'compact ms':>10}  same")
+
+    for page_type, (strainer, selectors, served) in bodies.items():
+        paths = page_types[page_type][0]
+        pages = [file.read_text("utf-8") for path in paths if (file := fixture_path(page_type, path)).is_file()]
+        if not pages:
+            print(f"{page_type:<10} no fixtures, run `python -m bench.parsers --record` first")
+            continue
+
+        tags = [tag for page in pages for selector in selectors
+                if (tag := BeautifulSoup(page, "lxml", parse_only=strainer).select_one(selector))]
+
+        pretty_bytes, compact_bytes = (sum(len(render(served(tag)).encode()) for tag in tags)
+                                       for render in (Tag.prettify, compact_html))
+        pretty_ms, compact_ms = (timeit(lambda: [render(served(tag)) for tag in tags], number=number) * 1000 / number
+                                 for render in (Tag.prettify, compact_html))
+        same = all(compact_html(served(tag)) == compact_html(tag) for tag in tags)
+        print(f"{page_type:<10} {len(tags):>6} {pretty_bytes:>9} {compact_bytes:>9}"
+              f" {compact_bytes / pretty_bytes:>6.0%} {pretty_ms:>9.2f} {compact_ms:>10.2f}  {same}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--number", type=int, default=50, help="serializations per field when timing")
+    bench(parser.parse_args().number)
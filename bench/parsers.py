@@ -0,0 +1,89 @@
+"""parse time and peak memory of full-page vs. strained parsing, per page type
+
+the committed fixtures are small hand-written pages in the site's markup, page chrome included,
+`tests/test_parsers.py` checks on them that strained and full parses extract the same.
+record fixtures from the live site to replace them, then benchmark against them offline:
+
+    python -m bench.parsers --record
+    python -m bench.parsers
+"""
+
+from core.info.homes import parse_resthomes, parse_resthome_details, parse_cities
+from core.info.homes import resthomes_strainer, resthome_strainer, cities_strainer
+from core.info.news import parse_articles, parse_article, articles_strainer, article_strainer
+from argparse import ArgumentParser
+from bs4 import BeautifulSoup
+from pathlib import Path
+from timeit import timeit
+import tracemalloc
+import asyncio
+
+fixtures = Path(__file__).parent / "fixtures"
+
+page_types = {
+    # page type: (paths to record, extractor, strainer)
+    "articles": (["/article_1", "/article_2"], parse_articles, articles_strainer),
+    "article": (["/article/521502.html", "/article/514020.html", "/article/520563.html"], parse_article,
+                article_strainer),
+    "resthomes": (["/resthome_1", "/resthome_2"], parse_resthomes, resthomes_strainer),
+    "resthome": (["/resthome/22606.html", "/resthome/1248029.html", "/resthome/1247903.html"],
+                 parse_resthome_details, resthome_strainer),
+    "cities": (["/city"], parse_cities, cities_strainer),
+}
+
+
+def fixture_path(page_type: str, path: str):
+    return fixtures / f"{page_type}-{path.strip('/').replace('/', '_').removesuffix('.html')}.html"
+
+
+async def record():
+    from core.info.common import client
+
+    for page_type, (paths, _, _) in page_types.items():
+        for path in paths:
+            res = await client.get(path)
+            res.raise_for_status()
+            fixture_path(page_type, path).write_text(res.text, "utf-8")
+            print(f"recorded {path}")
+
+
+def peak_memory(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench(number: int):
+    print(f"{'page type':<10} {'pages':>5} {'old ms':>8} {'new ms':>8} {'old KiB':>9} {'new KiB':>9}  identical")
+
+    for page_type, (paths, extract, strainer) in page_types.items():
+        pages = [file.read_text("utf-8") for path in paths if (file := fixture_path(page_type, path)).is_file()]
+        if not pages:
+            print(f"{page_type:<10} no fixtures, run with --record first")
+            continue
+
+        def old():
+            return [extract(BeautifulSoup(page, "lxml")) for page in pages]
+
+        def new():
+            return [extract(BeautifulSoup(page, "lxml", parse_only=strainer)) for page in pages]
+
+        old_ms, new_ms = (timeit(run, number=number) * 1000 / number / len(pages) for run in (old, new))
+        old_kib, new_kib = (peak_memory(run) / 1024 / len(pages) for run in (old, new))
+        print(f"{page_type:<10} {len(pages):>5} {old_ms:>8.2f} {new_ms:>8.2f} {old_kib:>9.0f} {new_kib:>9.0f}"
+              f"  {old() == new()}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--record", action="store_true", help="fetch the fixtures from the live site first")
+    parser.add_argument("-n", "--number", type=int, default=20, help="parses per page when timing")
+    args = parser.parse_args()
+
+    if args.record:
+        fixtures.mkdir(exist_ok=True)
+        asyncio.run(record())
+    bench(args.number)
@@ -1,11 +1,12 @@
 from fastapi import APIRouter, Response, Path
-from httpx import AsyncClient
+from ..common.disk_cache import image_cache
+from starlette.responses import FileResponse
+from ..common.http import insecure as client
 from random import choice, randrange
 from pydantic import BaseModel
 
 router = APIRouter(tags=["card"])
 names = open("core/card/names.txt", encoding="utf-8").read().split()
-client = AsyncClient(http2=True, follow_redirects=True, verify=False)
 
 
 class HomeCard(BaseModel):
@@ -32,21 +33,13 @@ def get_homes(n: int = Path(ge=1, example=3)):
     ]
 
 
-image_cache = {}
-
-
 @router.get("/image/home/{n}")
 async def get_home_image(n: int):
-    if n in image_cache:
-        response = image_cache[n]
-        return response
-
-    r = await client.get("https://place.dog/800/400")
-    headers = r.headers
-    for key in ["content-length", "content-length"]:
-        if key in headers:
-            del headers[key]
-
-    response = Response(r.content, r.status_code, headers)
-    image_cache[n] = response
-    return response
+    if (entry := image_cache.get(key := f"card:{n}")) is None:
+        r = await client.get("https://place.dog/800/400")
+        if not r.is_success or (entry := image_cache.put_bytes(key, r.content, {
+            "content-type": r.headers.get("content-type", "image/jpeg"), "cache-control": "max-age=86400"
+        })) is None:
+            return Response(r.content, r.status_code, media_type=r.headers.get("content-type"))
+
+    return FileResponse(image_cache.path(entry.digest), headers=entry.headers)
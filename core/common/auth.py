@@ -1,9 +1,46 @@
 from starlette.exceptions import HTTPException
 from fastapi import Header, Cookie, Query
 from .secret import app_secret_1 as sk_1
+from cachetools import TTLCache
+from threading import Lock
+from hashlib import sha256
 import jwt
 
 
+class VerifiedToken:
+    __slots__ = ("id", "snapshot")
+
+    def __init__(self, id: str):
+        self.id = id
+        self.snapshot = None  # (UserItem, meta) as loaded by the first `Bearer.user` of this token
+
+
+# sha256 of a token -> its claims and user, so repeated requests skip `jwt.decode` and the user query
+verified_tokens: TTLCache = TTLCache(4096, 60)
+verified_lock = Lock()  # class dependencies are constructed in the threadpool
+
+
+def verify(token: str) -> VerifiedToken:
+    key = sha256(token.encode()).digest()
+    with verified_lock:
+        if (verified := verified_tokens.get(key)) is not None:
+            return verified
+    verified = VerifiedToken(jwt.decode(token, sk_1, "HS256")["id"])
+    with verified_lock:
+        verified_tokens[key] = verified
+    return verified
+
+
+def forget_tokens(user_id: str):
+    """drop the cached tokens of a user, e.g. after it changed its password or was erased
+
+    called on every worker through `existence.publish`
+    """
+    with verified_lock:
+        for key in [key for key, verified in verified_tokens.items() if verified.id == user_id]:
+            verified_tokens.pop(key, None)
+
+
 class Bearer:
     def __init__(self,
                  authorization: str = Header(None, include_in_schema=False),
@@ -16,10 +53,8 @@ class Bearer:
         try:
             if "Bearer " not in auth:
                 raise self.bearer_error
-            token = auth.removeprefix("Bearer ")
-            result = jwt.decode(token, sk_1, "HS256")
-
-            self.id = result["id"]
+            self.verified = verify(auth.removeprefix("Bearer "))
+            self.id = self.verified.id
 
         except (KeyError, jwt.InvalidSignatureError) as err:
             raise HTTPException(403, str(err))
@@ -28,12 +63,18 @@ class Bearer:
 
     @property
     def user(self):
-        from ..user.impl import User
+        from ..user.impl import User, loaded_users, copy_loaded
+
+        # the snapshot is shared by concurrent requests of this token, each one gets a copy of its own
+        if (snapshot := self.verified.snapshot) is None:
+            self.verified.snapshot = copy_loaded(User(self.id).load())
+        elif (loaded := loaded_users.get()) is not None and self.id not in loaded:
+            loaded[self.id] = copy_loaded(snapshot)
         return User(self.id)
 
     def ensure_been_permitted_by(self, to_user_id):
         from ..user.impl import verify_permitted
-        return verify_permitted(self.user.id, to_user_id)
+        return verify_permitted(self.id, to_user_id)
 
     @property
     def no_auth_error(self):
@@ -46,8 +87,7 @@ class Bearer:
 
 def parse_id(token: str):
     try:
-        payload = jwt.decode(token.removeprefix("Bearer "), sk_1, "HS256")
-        return payload["id"]
+        return verify(token.removeprefix("Bearer ")).id
     except jwt.InvalidSignatureError as err:
         raise HTTPException(403, str(err))
     except jwt.DecodeError as err:
@@ -0,0 +1,176 @@
+from email.utils import parsedate_to_datetime
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+from hashlib import sha256
+from itertools import count
+from pathlib import Path
+from time import time
+import pickle
+import re
+
+try:
+    from fcntl import flock, LOCK_EX, LOCK_NB
+except ImportError:  # windows, only used for a single dev server
+    flock = None
+
+max_age_reg = re.compile(r"(?:s-maxage|max-age)=(\d+)")
+kept_headers = ("content-type", "etag", "last-modified", "cache-control")
+
+
+def freshness_lifetime(headers, default: float) -> float | None:
+    """seconds a response may be served without revalidation, None if it mustn't be stored at all"""
+    cache_control = headers.get("cache-control", "").lower()
+    if "no-store" in cache_control or "private" in cache_control:
+        return None
+    if "no-cache" in cache_control:
+        return 0
+    if match := max_age_reg.search(cache_control):
+        return int(match[1])
+    if expires := headers.get("expires"):
+        try:
+            return max(0.0, parsedate_to_datetime(expires).timestamp() - time())
+        except (TypeError, ValueError):
+            return 0
+    return default
+
+
+@dataclass
+class Entry:
+    digest: str
+    size: int
+    headers: dict[str, str]
+    expires: float = field(default=0.0)
+
+    @property
+    def fresh(self):
+        return self.expires > time()
+
+
+class DiskCache:
+    """content-addressed blobs under `root`, evicted least-recently-used first once over `budget` bytes
+
+    the index lives in memory, so `root` must belong to this process alone, see `claim_directory`
+    """
+
+    def __init__(self, root: Path, budget: int, default_ttl: float = 86400):
+        self.root = root
+        self.budget = budget
+        self.max_item_size = budget // 8
+        self.default_ttl = default_ttl
+        self.entries: OrderedDict[str, Entry] = OrderedDict()
+        self.refs = Counter()  # digest -> number of keys sharing the blob
+        self.size = 0
+        self.stats = Counter(hits=0, misses=0, evictions=0, revalidations=0)
+
+    def path(self, digest: str):
+        return self.root / "blobs" / digest[:2] / digest
+
+    def temp_path(self, name: str):
+        (tmp := self.root / "tmp").mkdir(parents=True, exist_ok=True)
+        return tmp / name
+
+    def get(self, key: str) -> Entry | None:
+        if (entry := self.entries.get(key)) is None:
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry
+
+    def put_file(self, key: str, file: Path, digest: str, headers) -> Entry | None:
+        """move a fully written temporary file into the cache, unless the headers forbid storing it"""
+        size = file.stat().st_size
+        if (ttl := freshness_lifetime(headers, self.default_ttl)) is None or size > self.max_item_size:
+            file.unlink(missing_ok=True)
+            return None
+
+        self.discard(key)
+        if self.refs[digest] == 0:
+            (path := self.path(digest)).parent.mkdir(parents=True, exist_ok=True)
+            file.replace(path)
+            self.size += size
+        else:
+            file.unlink(missing_ok=True)
+        self.refs[digest] += 1
+
+        entry = self.entries[key] = Entry(digest, size, {k: v for k in kept_headers if (v := headers.get(k))},
+                                          time() + ttl)
+        self.evict()
+        return entry
+
+    def put_bytes(self, key: str, content: bytes, headers) -> Entry | None:
+        digest = sha256(content).hexdigest()
+        (file := self.temp_path(digest)).write_bytes(content)
+        return self.put_file(key, file, digest, headers)
+
+    def revalidated(self, key: str, headers):
+        """an upstream 304 confirmed the cached entry, extend its freshness"""
+        if (entry := self.entries.get(key)) is not None:
+            entry.expires = time() + (freshness_lifetime(headers, self.default_ttl) or 0)
+            self.stats["revalidations"] += 1
+
+    def discard(self, key: str):
+        if (entry := self.entries.pop(key, None)) is None:
+            return
+        self.refs[entry.digest] -= 1
+        if self.refs[entry.digest] == 0:
+            del self.refs[entry.digest]
+            self.path(entry.digest).unlink(missing_ok=True)
+            self.size -= entry.size
+
+    def evict(self):
+        while self.size > self.budget and self.entries:
+            self.discard(next(iter(self.entries)))
+            self.stats["evictions"] += 1
+
+    def save(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        with (self.root / "index.pickle").open("wb") as f:
+            pickle.dump(self.entries, f, pickle.HIGHEST_PROTOCOL)
+
+    def load(self):
+        if (index := self.root / "index.pickle").is_file():
+            with index.open("rb") as f:
+                entries: OrderedDict[str, Entry] = pickle.load(f)
+            for key, entry in entries.items():
+                if self.path(entry.digest).is_file():
+                    self.entries[key] = entry
+                    if self.refs[entry.digest] == 0:
+                        self.size += entry.size
+                    self.refs[entry.digest] += 1
+            self.evict()
+        for blob in self.root.glob("blobs/*/*"):
+            if blob.name not in self.refs:  # written but never indexed, e.g. killed before `save`
+                blob.unlink()
+        return self
+
+    def report(self):
+        return dict(self.stats, entries=len(self.entries), bytes=self.size, budget=self.budget)
+
+
+claimed = []  # the open lock files, closing them would hand the directories to another process
+
+
+def claim_directory(root: Path) -> Path:
+    """a numbered subdirectory of `root` locked for this process, numbers of exited processes are reused
+
+    every worker gets a cache directory and budget of its own, so none evicts a blob another still serves
+    """
+    for slot in count():
+        (path := root / str(slot)).mkdir(parents=True, exist_ok=True)
+        if flock is None:
+            return path
+        lock = (path / "lock").open("wb")
+        try:
+            flock(lock, LOCK_EX | LOCK_NB)
+        except OSError:
+            lock.close()
+            continue
+        claimed.append(lock)
+        return path
+
+
+image_cache = DiskCache(claim_directory(Path("data/cache")), 256 << 20).load()
+
+
+__all__ = ["DiskCache", "Entry", "freshness_lifetime", "image_cache"]
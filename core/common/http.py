@@ -0,0 +1,208 @@
+from httpx import AsyncClient, AsyncHTTPTransport, AsyncByteStream, Limits, Timeout, Request, Response
+from httpx import TransportError
+from dataclasses import dataclass
+from time import monotonic
+import asyncio
+
+
+@dataclass
+class HostRule:
+    max_connections: int = 32  # requests in flight to this host, streamed bodies count until read through or closed
+    rate: float | None = None  # requests per second, unlimited if None
+    burst: int = 1
+    failure_threshold: int = 5  # consecutive failures that open the circuit
+    cooldown: float = 30.0  # seconds an open circuit fails fast before letting one trial through
+
+
+rules = {
+    "www.yanglao.com.cn": HostRule(max_connections=16, rate=8, burst=16),
+}
+
+
+class Unavailable(TransportError):
+    """the host is not tried at all right now, callers answer 503 instead of 502"""
+
+
+class CircuitOpen(Unavailable):
+    pass
+
+
+class HostBusy(Unavailable):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = monotonic()
+
+    async def acquire(self):
+        while True:
+            now = monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: float | None = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "open" if monotonic() - self.opened_at < self.cooldown else "half-open"
+
+    def allow(self):
+        match self.state:
+            case "closed":
+                return True
+            case "half-open":
+                self.opened_at = monotonic()  # one trial at a time, the others keep failing fast
+                return True
+        return False
+
+    def succeeded(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def failed(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.opened_at = monotonic()
+
+
+class HostGuard:
+    def __init__(self, rule: HostRule):
+        self.slots = asyncio.Semaphore(rule.max_connections)
+        self.bucket = rule.rate and TokenBucket(rule.rate, rule.burst)
+        self.breaker = CircuitBreaker(rule.failure_threshold, rule.cooldown)
+
+
+guards: dict[str, HostGuard] = {}
+
+
+def guard_for(host: str):
+    if (guard := guards.get(host)) is None:
+        guard = guards[host] = HostGuard(rules.get(host, HostRule()))
+    return guard
+
+
+class ReleasingStream(AsyncByteStream):
+    """gives the host slot back once the body is read through, fails or is closed, whichever comes first
+
+    a response only counts as a success for the circuit breaker once its body has been read through
+    """
+
+    def __init__(self, stream: AsyncByteStream, guard: HostGuard, ok: bool):
+        self.stream = stream
+        self.guard = guard
+        self.ok = ok
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.guard.slots.release()
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self.stream:
+                yield chunk
+        except TransportError:
+            self.guard.breaker.failed()  # the headers looked fine, but the host broke off midway
+            raise
+        else:
+            if self.ok:
+                self.guard.breaker.succeeded()
+        finally:
+            self.release()
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            self.release()
+
+
+class GuardedTransport(AsyncHTTPTransport):
+    """applies the per-host connection limit, rate limit and circuit breaker shared by every client"""
+
+    async def handle_async_request(self, request: Request) -> Response:
+        guard = guard_for(request.url.host)
+        if not guard.breaker.allow():
+            raise CircuitOpen(f"{request.url.host} keeps failing, not trying again for a while", request=request)
+        if guard.bucket:
+            await guard.bucket.acquire()
+
+        try:
+            await asyncio.wait_for(guard.slots.acquire(), request.extensions.get("timeout", {}).get("pool"))
+        except asyncio.TimeoutError:
+            raise HostBusy(f"too many requests in flight to {request.url.host}, try again later", request=request)
+        try:
+            response = await super().handle_async_request(request)
+        except BaseException as err:
+            guard.slots.release()
+            if isinstance(err, TransportError):
+                guard.breaker.failed()
+            raise
+
+        if response.status_code >= 500:
+            guard.breaker.failed()
+        response.stream = ReleasingStream(response.stream, guard, response.status_code < 500)
+        return response
+
+
+limits = Limits(max_connections=128, max_keepalive_connections=32)
+timeout = Timeout(10, connect=5)
+clients: dict[str, AsyncClient] = {}
+
+
+def new_client(name: str, *, verify=True, **kwargs):
+    client = clients[name] = AsyncClient(
+        transport=GuardedTransport(http2=True, verify=verify, limits=limits), timeout=timeout, **kwargs
+    )
+    return client
+
+
+scraper = new_client("scraper", verify=False, base_url="https://www.yanglao.com.cn/", headers={
+    "user-agent": "gp-scraper / Guard Pine (https://gp.muspimerol.site/)",
+    "x-scraper-contact-email": "admin@muspimerol.site",
+    "x-gp-repo": "https://jihulab.com/CNSeniorious000/gp-backend"
+})
+default = new_client("default")
+insecure = new_client("insecure", verify=False, follow_redirects=True)
+
+warm_up = [(scraper, "/")]
+
+
+async def prewarm():
+    """open the connections we are about to need before the first user request does"""
+    await asyncio.gather(*(client.head(url) for client, url in warm_up), return_exceptions=True)
+
+
+async def aclose_all():
+    await asyncio.gather(*(client.aclose() for client in clients.values()), return_exceptions=True)
+
+
+def report():
+    return {
+        host: {
+            "circuit": guard.breaker.state,
+            "failures": guard.breaker.failures,
+            "inFlight": rules.get(host, HostRule()).max_connections - guard.slots._value,
+            "tokens": guard.bucket and round(guard.bucket.tokens, 2)
+        } for host, guard in guards.items()
+    }
+
+
+__all__ = ["scraper", "default", "insecure", "new_client", "prewarm", "aclose_all", "report", "Unavailable", "CircuitOpen", "HostBusy"]
@@ -0,0 +1,38 @@
+from redis import Redis, RedisError
+from redis.exceptions import LockError
+from .secret import pool
+
+leaders = Redis(connection_pool=pool)
+
+
+class Leader:
+    """at most one worker at a time holds the redis lock `name`, for background jobs that must not run once per worker
+
+    `lead()` takes the lock or renews it and tells whether this worker holds it,
+    a holder that stops renewing for `lease` seconds, e.g. because it exited, is replaced by the next worker asking
+    """
+
+    def __init__(self, name: str, lease=60.0):
+        self.lock = leaders.lock(name, timeout=lease, thread_local=False)
+        self.leading = False
+
+    def lead(self) -> bool:
+        try:
+            if self.leading:
+                self.lock.reacquire()
+            else:
+                self.leading = self.lock.acquire(blocking=False)
+        except LockError:  # expired, and maybe taken by another worker meanwhile
+            self.leading = False
+        except RedisError as err:
+            print(err)
+            self.leading = False
+        return self.leading
+
+    def resign(self):
+        if self.leading:
+            self.leading = False
+            try:
+                self.lock.release()
+            except RedisError as err:
+                print(err)
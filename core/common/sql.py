@@ -1,11 +1,35 @@
 from sqlmodel import SQLModel, create_engine
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy import inspect, text
 from .secret import *
+from . import secret
 
-engine = create_engine(f"{dialect}+{driver}://{user}:{password}@{host}:{port}/{db}")
+# a full `database_url` in secret takes precedence, e.g. sqlite for the tests
+engine = create_engine(getattr(secret, "database_url", None) or
+                       f"{dialect}+{driver}://{user}:{password}@{host}:{port}/{db}")
+
+
+def upgrade_tables():
+    """`create_all` skips existing tables, so add the nullable columns and indexes declared since they were created"""
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in SQLModel.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in columns and column.nullable:
+                    ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"))
+            indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
 
 
 def create_db_and_tables():
-    return SQLModel.metadata.create_all(engine)
+    SQLModel.metadata.create_all(engine)
+    upgrade_tables()
 
 
 __all__ = ["engine", "create_db_and_tables"]
@@ -1,2 +1,2 @@
-from . import news, homes, proxy
+from . import news, homes, proxy, crawler, search, regions, catalog
 from .common import router
@@ -0,0 +1,259 @@
+from sqlmodel import SQLModel, Field as DbField, Session, select
+from sqlalchemy import Column, Text, update
+from sqlalchemy.exc import IntegrityError
+from math import radians, cos, sin, asin, sqrt, floor
+from pydantic import Field
+from fastapi import Query
+from collections import defaultdict
+from ..common.http import default as client
+from .common import router
+from ..common.sql import engine
+from .homes import Resthome
+from datetime import datetime
+from ..common import secret
+import asyncio
+
+geocode_key = getattr(secret, "amap_key", None)  # AMap web service key, resthomes stay unlocated without it
+
+
+class ResthomeItem(SQLModel, table=True):
+    __tablename__ = "resthomes"
+    resthome_id: int = DbField(primary_key=True, sa_column_kwargs={"autoincrement": False})
+    title: str
+    loc: str
+    bed_count: int
+    pricing: str
+    image: str | None
+    region_id: str | None = DbField(default=None, index=True)
+    general: str | None = DbField(default=None, sa_column=Column(Text))
+    tel: str | None = None
+    lng: float | None = None
+    lat: float | None = None
+    geocoded_at: datetime | None = None  # set when claimed and on failures too, so they are not retried forever
+    updated_at: datetime = DbField(default_factory=datetime.utcnow)
+
+
+def update_item(item: ResthomeItem, data: dict):
+    if item.loc != data["loc"]:
+        item.lng = item.lat = item.geocoded_at = None  # moved, locate it again
+        grid.remove(item.resthome_id)
+    item.title, item.loc, item.pricing = data["title"], data["loc"], data["pricing"]
+    item.bed_count = data["bedCount"]
+    item.updated_at = datetime.utcnow()
+
+
+def save_to_catalog(write, *args):
+    """catalog writes are a side effect of serving a page, so they never fail the response"""
+    try:
+        try:
+            write(*args)
+        except IntegrityError:  # another worker inserted one of these ids after our lookup, now it's an update
+            write(*args)
+    except Exception as err:
+        print(f"failed to update the resthome catalog: {err!r}")
+
+
+def upsert_resthomes(items: list[dict], region_id: str | None):
+    save_to_catalog(write_resthomes, items, region_id)
+
+
+def upsert_resthome_details(resthome_id: int, data: dict):
+    save_to_catalog(write_resthome_details, resthome_id, data)
+
+
+def write_resthomes(items: list[dict], region_id: str | None):
+    """store the listing items of `get_resthomes`, keeping coordinates that are already known"""
+    with Session(engine) as session:
+        known = {item.resthome_id: item for item in session.exec(select(ResthomeItem).where(
+            ResthomeItem.resthome_id.in_([data["resthomeId"] for data in items])
+        ))}
+        for data in items:
+            item = known.get(data["resthomeId"]) or ResthomeItem(resthome_id=data["resthomeId"])
+            update_item(item, data)
+            item.image = data.get("image")
+            item.region_id = region_id or item.region_id
+            session.add(item)
+        session.commit()
+
+
+def write_resthome_details(resthome_id: int, data: dict):
+    with Session(engine) as session:
+        item = session.get(ResthomeItem, resthome_id) or ResthomeItem(resthome_id=resthome_id)
+        update_item(item, data)
+        item.image = item.image or next(iter(data["images"]), None)
+        item.general, item.tel = data["general"], data.get("tel")
+        session.add(item)
+        session.commit()
+
+
+def haversine(lng1, lat1, lng2, lat2):
+    """great-circle distance in meters"""
+    lng1, lat1, lng2, lat2 = map(radians, (lng1, lat1, lng2, lat2))
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lng2 - lng1) / 2) ** 2
+    return 2 * 6371008.8 * asin(sqrt(a))
+
+
+class GridIndex:
+    """points bucketed into `cell`-degree squares, a radius query only scans the cells its bounding box touches"""
+
+    def __init__(self, cell=0.05):
+        self.cell = cell
+        self.cells: defaultdict[tuple[int, int], set[int]] = defaultdict(set)
+        self.points: dict[int, tuple[float, float]] = {}
+
+    def key(self, lng: float, lat: float):
+        return floor(lng / self.cell), floor(lat / self.cell)
+
+    def add(self, point_id: int, lng: float, lat: float):
+        self.remove(point_id)
+        self.points[point_id] = lng, lat
+        self.cells[self.key(lng, lat)].add(point_id)
+
+    def remove(self, point_id: int):
+        if (point := self.points.pop(point_id, None)) is not None:
+            (cell := self.cells[key := self.key(*point)]).discard(point_id)
+            if not cell:
+                del self.cells[key]
+
+    def nearby(self, lng: float, lat: float, radius: float, limit: int):
+        d_lat = radius / 111_320
+        d_lng = radius / (111_320 * max(cos(radians(lat)), 1e-6))
+        (x0, y0), (x1, y1) = self.key(lng - d_lng, lat - d_lat), self.key(lng + d_lng, lat + d_lat)
+        found = []
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                # queries run in the threadpool while the event loop may be adding points, iterate over copies
+                for point_id in tuple(self.cells.get((x, y), ())):
+                    if (point := self.points.get(point_id)) and (distance := haversine(lng, lat, *point)) <= radius:
+                        found.append((distance, point_id))
+        found.sort()
+        return found[:limit]
+
+
+grid = GridIndex()
+
+
+def load_grid():
+    fresh = GridIndex()
+    with Session(engine) as session:
+        for resthome_id, lng, lat in session.exec(select(
+                ResthomeItem.resthome_id, ResthomeItem.lng, ResthomeItem.lat
+        ).where(ResthomeItem.lat != None)):  # noqa: E711
+            fresh.add(resthome_id, lng, lat)
+    return fresh
+
+
+async def refresh_grid(interval=60.0):
+    """reload the grid from the table every `interval` seconds, picking up what other workers have geocoded"""
+    global grid
+    while True:
+        try:
+            grid = await asyncio.to_thread(load_grid)
+        except Exception as err:
+            print(f"failed to reload the resthome grid: {err!r}")
+        await asyncio.sleep(interval)
+
+
+async def geocode(address: str, city: str | None):
+    res = await client.get("https://restapi.amap.com/v3/geocode/geo",
+                           params={"key": geocode_key, "address": address, "city": city or ""})
+    if res.is_success and (geocodes := res.json().get("geocodes")):
+        lng, lat = geocodes[0]["location"].split(",")
+        return float(lng), float(lat)
+
+
+class Geocoder:
+    """locates catalogued resthomes in background, at most one geocoding request per `interval` seconds
+
+    every worker runs one, each resthome is claimed in the table first so that only one of them geocodes it
+    """
+
+    def __init__(self, interval=0.5, idle=600.0):
+        self.interval = interval
+        self.idle = idle
+        self.task: asyncio.Task | None = None
+
+    def start(self):
+        if geocode_key is not None and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def run(self):
+        from .regions import region_tree
+
+        while True:
+            with Session(engine) as session:
+                pending = session.exec(
+                    select(ResthomeItem).where(ResthomeItem.geocoded_at == None).limit(50)  # noqa: E711
+                ).all()
+            if not pending:
+                await asyncio.sleep(self.idle)
+                continue
+
+            for item in pending:
+                if not claim(item.resthome_id):
+                    continue  # another worker got it first
+                city = None
+                if item.region_id in region_tree:
+                    node = region_tree.nodes[item.region_id]
+                    city = region_tree.nodes[node["parent"]]["name"] if node["parent"] else node["name"]
+                try:
+                    location = await geocode(item.loc, city)
+                except Exception as err:
+                    print(f"failed to geocode resthome {item.resthome_id}: {err!r}")
+                    location = None
+
+                with Session(engine) as session:
+                    item = session.get(ResthomeItem, item.resthome_id)
+                    item.geocoded_at = datetime.utcnow()
+                    if location is not None:
+                        item.lng, item.lat = location
+                        grid.add(item.resthome_id, *location)
+                    session.add(item)
+                    session.commit()
+                await asyncio.sleep(self.interval)
+
+
+def claim(resthome_id: int):
+    with Session(engine) as session:
+        claimed = session.exec(update(ResthomeItem).where(
+            ResthomeItem.resthome_id == resthome_id, ResthomeItem.geocoded_at == None  # noqa: E711
+        ).values(geocoded_at=datetime.utcnow())).rowcount
+        session.commit()
+    return claimed == 1
+
+
+geocoder = Geocoder()
+
+
+class NearbyResthome(Resthome):
+    lng: float = Field(title="经度")
+    lat: float = Field(title="纬度")
+    distance: float = Field(title="距离", description="单位为米")
+
+
+@router.get("/resthomes/nearby", response_model=list[NearbyResthome])
+def get_nearby_resthomes(lat: float = Query(ge=-90, le=90, example=22.3571951),
+                         lng: float = Query(ge=-180, le=180, example=113.5430570),
+                         radius: float = Query(5000, gt=0, le=100_000, description="单位为米"),
+                         limit: int = Query(20, ge=1, le=100)):
+    """resthomes from the local catalog within `radius` meters, nearest first
+
+    only resthomes that have appeared in a listing or been viewed before and been geocoded are included
+    """
+    found = grid.nearby(lng, lat, radius, limit)
+    with Session(engine) as session:
+        items = {item.resthome_id: item for item in session.exec(select(ResthomeItem).where(
+            ResthomeItem.resthome_id.in_([resthome_id for _, resthome_id in found])
+        ))}
+    return [{
+        "title": item.title, "loc": item.loc, "bedCount": item.bed_count, "pricing": item.pricing,
+        "resthomeId": item.resthome_id, "image": item.image, "lng": item.lng, "lat": item.lat, "distance": distance
+    } for distance, resthome_id in found if (item := items.get(resthome_id)) is not None]
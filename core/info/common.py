@@ -1,6 +1,10 @@
 from fastapi import APIRouter, HTTPException
-from httpx import AsyncClient
-from bs4 import BeautifulSoup
+from collections import Counter
+from cachetools import LRUCache
+from ..common.http import scraper, report, Unavailable
+from httpx import HTTPError
+from bs4 import BeautifulSoup, SoupStrainer
+import asyncio
 import re
 
 router = APIRouter(tags=["info"])
@@ -8,16 +12,90 @@ router = APIRouter(tags=["info"])
 get_id_reg = re.compile(r"\d+")
 sub_str_reg = re.compile(r"\n|\r|\t| +")
 
-client = AsyncClient(http2=True, base_url="https://www.yanglao.com.cn/", verify=False, headers={
-    "user-agent": "gp-scraper / Guard Pine (https://gp.muspimerol.site/)",
-    "x-scraper-contact-email": "admin@muspimerol.site",
-    "x-gp-repo": "https://jihulab.com/CNSeniorious000/gp-backend"
-})
+client = scraper
 
 
-async def get_html(path: str) -> BeautifulSoup:
-    res = await client.get(path)
-    if res.is_success:
-        return BeautifulSoup(res.text, "lxml")
+class SubtreeStrainer(SoupStrainer):
+    """only build the subtrees rooted at tags matching any of the `tag`, `tag.class` or `#id` selectors
+
+    lxml still tokenizes the whole page, but bs4 skips creating everything outside these subtrees
+    """
+
+    def __init__(self, *selectors: str):
+        super().__init__()
+        self.rules = []
+        for selector in selectors:
+            name, _, tag_id = selector.partition("#")
+            name, _, class_name = name.partition(".")
+            self.rules.append((name or None, class_name or None, tag_id or None))
+
+    def matches(self, name: str, attrs: dict):
+        classes = attrs.get("class") or ""
+        if isinstance(classes, str):  # class attributes are not split yet while parsing
+            classes = classes.split()
+        return any(
+            (tag_name is None or tag_name == name) and
+            (class_name is None or class_name in classes) and
+            (tag_id is None or tag_id == attrs.get("id"))
+            for tag_name, class_name, tag_id in self.rules
+        )
+
+    def search_tag(self, markup_name=None, markup_attrs={}):  # bs4 < 4.13
+        return self.matches(markup_name, markup_attrs)
+
+    def allow_tag_creation(self, nsprefix, name, attrs):  # bs4 >= 4.13
+        return self.matches(name, attrs or {})
+
+
+in_flight: dict[str | tuple[str, SoupStrainer], asyncio.Task] = {}
+fetch_stats: LRUCache = LRUCache(4096)  # path -> Counter(fetched=..., coalesced=...)
+fetch_totals = Counter()
+
+
+async def fetch_html(path: str, parse_only: SoupStrainer = None) -> BeautifulSoup:
+    try:
+        res = await client.get(path)
+    except Unavailable as err:
+        raise HTTPException(503, str(err))
+    except HTTPError as err:
+        raise HTTPException(502, f"{type(err).__name__}: {err}")
+    if res.is_success:  # parsing a whole page takes milliseconds, keep it off the event loop
+        return await asyncio.to_thread(BeautifulSoup, res.text, "lxml", parse_only=parse_only)
     else:
         raise HTTPException(res.status_code, res.text)
+
+
+async def get_html(path: str, parse_only: SoupStrainer = None) -> BeautifulSoup:
+    """concurrent callers of the same path share one in-flight fetch and one parsed result
+
+    pass a `SubtreeStrainer` as `parse_only` to build only the parts of the page that will be selected
+    """
+
+    if (stats := fetch_stats.get(path)) is None:
+        stats = fetch_stats[path] = Counter()
+
+    key = path if parse_only is None else (path, parse_only)
+    if (task := in_flight.get(key)) is None:
+        in_flight[key] = task = asyncio.create_task(fetch_html(path, parse_only))
+        task.add_done_callback(lambda _: in_flight.pop(key, None))
+        stats["fetched"] += 1
+        fetch_totals["fetched"] += 1
+    else:
+        stats["coalesced"] += 1
+        fetch_totals["coalesced"] += 1
+
+    # a cancelled caller must not cancel the fetch other callers are waiting on
+    return await asyncio.shield(task)
+
+
+@router.get("/fetch_stats", tags=["dev"])
+def get_fetch_stats(top: int = 20):
+    """upstream fetches issued vs. saved by request coalescing, in total and for the busiest paths"""
+    busiest = sorted(fetch_stats.items(), key=lambda item: item[1]["coalesced"], reverse=True)[:top]
+    return {"total": fetch_totals, "paths": dict(busiest)}
+
+
+@router.get("/upstreams", tags=["dev"])
+def get_upstream_states():
+    """circuit state, in-flight requests and rate limit tokens of every host we have talked to"""
+    return report()
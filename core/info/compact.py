@@ -0,0 +1,88 @@
+from bs4 import BeautifulSoup, NavigableString, Tag
+from fastapi import Query, Header
+from cachetools import LRUCache, cached
+from html import escape
+from enum import Enum
+import re
+
+space_reg = re.compile(r"\s+")
+spaces_reg = re.compile(r" {2,}")  # left behind by unwrapped and dropped tags
+mobile_reg = re.compile(r"Mobile|Android|iPhone|iPad|MicroMessenger|miniProgram")
+
+dropped_tags = {"script", "style", "noscript", "iframe", "form", "input", "button", "select", "textarea", "link"}
+void_tags = {"br", "img", "hr"}
+block_tags = {"div", "p", "section", "article", "center", "blockquote", "ul", "ol", "li", "table", "thead", "tbody",
+              "tr", "td", "th", "h1", "h2", "h3", "h4", "h5", "h6"}
+unwrapped_tags = {"span", "font"}  # only carry styling, which is stripped anyway
+kept_attrs = {"a": ("href", "title"), "img": ("src", "alt"), "td": ("colspan", "rowspan"), "th": ("colspan", "rowspan")}
+
+
+class HtmlFormat(str, Enum):
+    pretty = "pretty"
+    compact = "compact"
+
+
+def html_format(format: HtmlFormat | None = Query(None, description="正文html的格式，默认移动端为 compact，其余为 pretty"),
+                user_agent: str = Header("", include_in_schema=False)) -> HtmlFormat:
+    if format is None:
+        return HtmlFormat.compact if mobile_reg.search(user_agent) else HtmlFormat.pretty
+    return format
+
+
+def attrs_of(tag: Tag):
+    for key in kept_attrs.get(tag.name, ()):
+        if isinstance(value := tag.get(key), str) and not (key == "href" and value.lstrip().lower().startswith(
+                "javascript:")):
+            yield f' {key}="{escape(value)}"'
+
+
+def write(node, out: list[str]):
+    if isinstance(node, NavigableString):
+        if type(node) is NavigableString:  # comments, doctypes and CDATA are dropped
+            out.append(escape(space_reg.sub(" ", node), quote=False))
+        return
+    if node.name in dropped_tags:
+        return
+
+    attrs = "".join(attrs_of(node))
+    if node.name in void_tags:
+        if node.name != "img" or attrs:
+            out.append(f"<{node.name}{attrs}>")
+        return
+
+    inner: list[str] = []
+    for child in node.children:
+        write(child, inner)
+    inner = "".join(inner)
+    if node.name in block_tags:
+        inner = inner.strip()
+
+    if isinstance(node, BeautifulSoup) or node.name in unwrapped_tags and not attrs:
+        out.append(inner)
+    elif inner.strip() not in ("", "<br>") or node.name in ("td", "th"):  # empty wrappers are dropped
+        out.append(f"<{node.name}{attrs}>{inner}</{node.name}>")
+
+
+def compact_html(tag: Tag) -> str:
+    """minified html without inline styles, scripts or empty wrappers, only reading `tag`
+
+    parsed pages are shared by coalesced requests, so the tree must not be modified here
+    """
+    out = []
+    write(tag, out)
+    return spaces_reg.sub(" ", "".join(out)).strip()
+
+
+@cached(LRUCache(1024))
+def compact_fragment(html: str) -> str:
+    """`compact_html` of a stored fragment, which must be unprettified or the indents end up in its text"""
+    return compact_html(BeautifulSoup(html, "html.parser"))
+
+
+@cached(LRUCache(1024))
+def pretty_fragment(html: str) -> str:
+    return BeautifulSoup(html, "html.parser").prettify()
+
+
+def render_fragment(html: str, format: HtmlFormat) -> str:
+    return compact_fragment(html) if format is HtmlFormat.compact else pretty_fragment(html)
@@ -0,0 +1,207 @@
+from .news import scrape_articles, ArticleWithDate, articles_per_page
+from starlette.exceptions import HTTPException
+from sqlmodel import Session, select, func
+from .search import index_article
+from .store import ArticleItem
+from ..common.sql import engine
+from ..common.leader import Leader, leaders
+from sqlalchemy.exc import IntegrityError
+from redis import RedisError
+from datetime import datetime
+from .common import router
+from fastapi import Query
+from orjson import dumps, loads
+from pathlib import Path
+from os import getpid
+from time import time
+import asyncio
+
+
+class ArticleCrawler:
+    """mirrors the `/article_{page}` listings into `articles`, newest first
+
+    each round walks the listing pages until it meets an already-known article id,
+    waiting `interval` seconds between two upstream requests to be polite.
+    a round that fails midway leaves the page it stopped at in `resume`, and the next round goes on
+    from there once it has caught up with the newest articles, so nothing behind the failure is skipped
+
+    every worker runs one, but only the `leader` crawls, so the upstream sees `interval` once, not once per worker.
+    `interval`, `period` and `progress` are shared in the redis hash `key`, any worker reports or reconfigures them
+    """
+
+    key = "crawler"
+
+    def __init__(self, path: Path, interval=2.0, period=1800.0, max_pages=50):
+        self.path = path
+        self.interval = interval
+        self.period = period
+        self.max_pages = max_pages
+        self.resume: list[int] = []  # listing pages not reached yet, as numbered when the round that left them ended
+        self.leader = Leader("crawler:leader")
+        self.task: asyncio.Task | None = None
+        self.progress = {"running": False, "page": 0, "inserted": 0, "lastRound": None, "lastError": None}
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.leader.resign()
+
+    def configure(self):
+        """pick up `interval` and `period`, whichever worker they were set on"""
+        try:
+            interval, period = leaders.hmget(self.key, "interval", "period")
+        except RedisError as err:
+            print(err)
+            return
+        self.interval, self.period = float(interval or self.interval), float(period or self.period)
+
+    def report(self, **shared):
+        try:
+            leaders.hset(self.key, mapping={"progress": dumps(self.progress | {"resume": self.resume}), **shared})
+        except RedisError as err:
+            print(err)
+
+    def due(self):
+        try:
+            finished = leaders.hget(self.key, "finished")
+        except RedisError as err:
+            print(err)
+            return False
+        return finished is None or time() - float(finished) >= self.period
+
+    async def run(self):
+        while True:
+            if self.leader.lead():
+                self.configure()
+                if self.due():
+                    await self.round()
+            await asyncio.sleep(self.leader.lock.timeout / 3)
+
+    async def round(self):
+        self.load()  # the previous round may have run on another worker
+        self.progress["running"] = True
+        self.report()
+        try:
+            await self.crawl()
+        except Exception as err:
+            self.progress["lastError"] = repr(err)
+        finally:
+            self.progress["running"] = False
+            self.progress["lastRound"] = datetime.utcnow()
+            self.report(finished=time())
+
+    async def crawl(self):
+        pending = sorted(self.resume)
+        published = 0  # articles newer than the previous round, they push the pending pages back
+        page, resumed_at = 1, None
+        try:
+            while page <= self.max_pages:
+                if not self.leader.lead():
+                    raise RuntimeError("lost the crawler lock to another worker")
+                self.configure()
+                self.progress["page"] = page
+                self.report()
+                try:
+                    articles = await scrape_articles(page)
+                except HTTPException as err:
+                    if err.status_code == 404:
+                        break  # walked past the last page
+                    raise
+                if not articles:
+                    break
+
+                new = self.upsert(articles)
+                if resumed_at is None:
+                    published += len(new)
+                    more = len(new) == len(articles)
+                else:  # the first resumed page may hold only known articles, the gap starts right after it
+                    more = articles[-1].articleId in new or page == resumed_at and not new
+
+                if more:
+                    page += 1
+                elif pending:
+                    page = resumed_at = pending.pop(0) + published // articles_per_page
+                else:
+                    break
+                await asyncio.sleep(self.interval)
+        except Exception:
+            self.resume = [page] + [resume_page + published // articles_per_page for resume_page in pending]
+            raise
+        else:
+            self.resume = []
+        finally:
+            self.save()
+
+    def upsert(self, articles: list[ArticleWithDate]):
+        """insert the articles not known yet, return their ids"""
+        try:
+            new = self.insert(articles)
+        except IntegrityError:  # inserted by someone else after our lookup, they are known now
+            new = self.insert(articles)
+        self.progress["inserted"] += len(new)
+        return new
+
+    @staticmethod
+    def insert(articles: list[ArticleWithDate]):
+        with Session(engine) as session:
+            known = set(session.exec(select(ArticleItem.article_id).where(
+                ArticleItem.article_id.in_([article.articleId for article in articles])
+            )))
+            new = set()
+            for article in articles:
+                if article.articleId in known or article.articleId in new:
+                    continue
+                session.add(ArticleItem(article_id=article.articleId, title=article.title, date=article.date))
+                index_article(article.articleId, article.title, article.date)
+                new.add(article.articleId)
+            session.commit()
+        return new
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(f".{getpid()}.tmp")  # a worker loading meanwhile must not see half of it
+        tmp.write_bytes(dumps({"resume": self.resume}))
+        tmp.replace(self.path)
+
+    def load(self):
+        try:
+            if self.path.is_file():
+                self.resume = loads(self.path.read_bytes())["resume"]
+        except Exception as err:  # the next round starts from the newest articles instead
+            print(f"failed to load {self.path}: {err!r}")
+        return self
+
+
+article_crawler = ArticleCrawler(Path("data/crawler.json")).load()
+
+
+@router.get("/crawler", tags=["dev"])
+def get_crawler_progress():
+    """progress of the worker crawling, whichever serves this"""
+    with Session(engine) as session:
+        count = session.exec(select(func.count()).select_from(ArticleItem)).one()
+    article_crawler.configure()
+    try:
+        progress = leaders.hget(article_crawler.key, "progress")
+    except RedisError as err:
+        print(err)
+        progress = None
+    return (loads(progress) if progress else article_crawler.progress | {"resume": article_crawler.resume}) | {
+        "articles": count, "interval": article_crawler.interval, "period": article_crawler.period
+    }
+
+
+@router.patch("/crawler", tags=["dev"])
+def configure_crawler(interval: float = Query(None, gt=0, description="两次请求之间的间隔（秒）"),
+                      period: float = Query(None, gt=0, description="两轮爬取之间的间隔（秒）")):
+    if config := {key: value for key, value in {"interval": interval, "period": period}.items() if value is not None}:
+        leaders.hset(article_crawler.key, mapping=config)  # the crawling worker picks it up before its next request
+    return get_crawler_progress()
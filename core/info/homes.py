@@ -1,8 +1,11 @@
-from .common import router, get_html, get_id_reg, sub_str_reg
+from .common import router, get_html, get_id_reg, sub_str_reg, SubtreeStrainer
+from .search import index_resthome
+from .compact import HtmlFormat, html_format, compact_html
+from starlette.exceptions import HTTPException
 from pydantic import BaseModel, Field
-from fastapi import Path, Query
-from enum import Enum
+from fastapi import Path, Query, Depends
 from bs4 import Tag
+import asyncio
 
 
 def parse_resthome_item(li: Tag):
@@ -73,11 +76,15 @@ class ResthomesResponse(BaseModel):
         }}
 
 
-@router.get("/resthomes", response_model=ResthomesResponse)
-async def get_resthomes(region: str = None, page: int = 1):
-    """rest homes and deeper region information from https://www.yanglao.com.cn/resthome"""
+resthomes_strainer = SubtreeStrainer("div.titbar", "div.filter", "div.list-view")
+resthome_strainer = SubtreeStrainer(
+    "div.inst-summary", "div.inst-pic", "div.base-info", "div.contact-info", "div.inst-charge", "div.facilities",
+    "div.service-content", "div.inst-notes", "div.inst-photos", "div.inst-intro", "#phonenum"
+)
+cities_strainer = SubtreeStrainer("div.citylist")
 
-    dom = await get_html(f"/{region or 'resthome'}_{page}")
+
+def parse_resthomes(dom) -> dict:
     data = {
         "title": dom.select_one("div.titbar > h3").string.rstrip("养老院列表"),
         "count": int(get_id_reg.findall(dom.select_one("div.filter span").string)[0]),
@@ -94,6 +101,65 @@ async def get_resthomes(region: str = None, page: int = 1):
     return data
 
 
+max_pages = 10
+
+
+def parse_page_range(pages: str):
+    first, _, last = pages.partition("-")
+    first, last = int(first), int(last or first)
+    if not 1 <= first <= last or last - first >= max_pages:
+        raise HTTPException(422, f"pages must be like 1-5, spanning at most {max_pages} pages")
+    return range(first, last + 1)
+
+
+def merge_resthomes(pages: list[dict]) -> dict:
+    data, seen = {**pages[0], "results": []}, set()
+    for page in pages:
+        for item in page["results"]:
+            if item["resthomeId"] not in seen:  # listings shift while we read them, an item may show up twice
+                seen.add(item["resthomeId"])
+                data["results"].append(item)
+    return data
+
+
+@router.get("/resthomes", response_model=ResthomesResponse, responses={404: {"description": "不存在该地区"}})
+async def get_resthomes(region: str = None, page: int = 1,
+                        pages: str | None = Query(None, regex=r"^\d+(-\d+)?$", example="1-5",
+                                                  description=f"一次取多页（最多{max_pages}页），会覆盖 page")):
+    """rest homes and deeper region information from https://www.yanglao.com.cn/resthome
+
+    with `pages` the listed pages are fetched concurrently and merged into one response
+    """
+
+    from .regions import region_tree
+    from .catalog import upsert_resthomes
+
+    if region is not None and region_tree.complete and region not in region_tree:
+        raise HTTPException(404, f"region {region} not found")
+
+    page_range = parse_page_range(pages) if pages else [page]
+    doms = await asyncio.gather(
+        *(get_html(f"/{region or 'resthome'}_{page}", resthomes_strainer) for page in page_range),
+        return_exceptions=True
+    )
+    parsed = []
+    for dom in doms:
+        if parsed and isinstance(dom, HTTPException) and dom.status_code == 404:
+            break  # walked past the last page, so are the pages after it
+        if isinstance(dom, BaseException):
+            raise dom  # a missing page in the middle would pass for a complete response
+        parsed.append(parse_resthomes(dom))
+    data = merge_resthomes(parsed)
+
+    if region is not None:
+        region_tree.set_children(region, data["subRegions"])
+    for item in data["results"]:
+        index_resthome(item["resthomeId"], item["title"], item["loc"], image=item.get("image"))
+    upsert_resthomes(data["results"], region)
+
+    return data
+
+
 def reformat_li(tags: list[Tag]):
     return "\n".join(map(lambda li: sub_str_reg.sub("", li.text).replace("\xa0", " "), tags))
 
@@ -194,9 +260,8 @@ class ResthomeDetails(BaseModel):
         }}
 
 
-@router.get("/resthome/{resthomeId}", response_model=ResthomeDetails)
-async def get_resthome_details(resthome_id: int = Path(alias="resthomeId")):
-    dom = await get_html(f"/resthome/{resthome_id}.html")
+def parse_resthome_details(dom, format=HtmlFormat.pretty) -> dict:
+    render = compact_html if format is HtmlFormat.compact else Tag.prettify
     location, bed_count, price = dom.select("div.inst-summary > ul li")[:3]
     data = {
         "title": dom.select_one("div.inst-summary > h1").string.strip(),
@@ -206,105 +271,34 @@ async def get_resthome_details(resthome_id: int = Path(alias="resthomeId")):
         "hits": dom.select("div.inst-pic > span")[-1].string.lstrip("人气："),
         "general": reformat_li(dom.select("div.base-info li")),
         "contact": reformat_li(dom.select("div.contact-info li")),
-        "htmlCharge": dom.select_one("div.inst-charge > div.cont").prettify(),
-        "htmlFacilities": dom.select_one("div.facilities > div.cont").prettify(),
-        "htmlService": dom.select_one("div.service-content > div.cont").prettify(),
-        "htmlNotes": dom.select_one("div.inst-notes > div.cont").prettify(),
+        "htmlCharge": render(dom.select_one("div.inst-charge > div.cont")),
+        "htmlFacilities": render(dom.select_one("div.facilities > div.cont")),
+        "htmlService": render(dom.select_one("div.service-content > div.cont")),
+        "htmlNotes": render(dom.select_one("div.inst-notes > div.cont")),
         "images": [img["src"] for img in dom.select("div.inst-photos img")]
     }
     if tel := dom.select_one("#phonenum"):
         data["tel"] = tel.string
     if html_intro := dom.select_one("div.inst-intro > div.cont"):
-        data["htmlIntro"] = html_intro.prettify()
+        data["htmlIntro"] = render(html_intro)
 
     return data
 
 
-@router.get("/cities", response_model=dict[str, list[Region]])
-async def get_cities():
-    """sitemap from https://www.yanglao.com.cn/city"""
-    return {
-        dl.dt.text.strip(): [{"name": a.string, "regionId": a["href"].lstrip("/")} for a in dl.select("dd.list a")]
-        for dl in (await get_html("/city")).select("div.citylist > dl")
-    }
-
+@router.get("/resthome/{resthomeId}", response_model=ResthomeDetails)
+async def get_resthome_details(resthome_id: int = Path(alias="resthomeId"),
+                               format: HtmlFormat = Depends(html_format)):
+    from .catalog import upsert_resthome_details
 
-class ResultType(Enum):
-    article = "article"
-    resthome = "resthome"
-
-
-class SearchResultItem(BaseModel):
-    title: str = Field(title="网页标题")
-    date: str = Field(title="日期", description="yyyy-dd-mm 格式")
-    abstract: str = Field(title="摘要", description="百度搜索那样的网页摘要")
-    type: ResultType | None = Field(title="结果类型",
-                                    description="如果是文章链接则有文章id，如果是机构链接的话则有机构id")
-    article_id: int | None = Field(alias="articleId", title="文章id",
-                                   description="如果是文章的话有，可以用来进入文章详情页")
-    restroom_id: int | None = Field(alias="restroomId", title="机构id",
-                                    description="如果是机构的话有，可以用来进入机构详情页")
-    href: str = Field(title="搜索结果的原始网页链接",
-                      description="搜索的原结果，是一个网页链接，不管是不是文章或者机构都有")
-    image: str | None = Field(title="网页图片", description="很少有，而且一般不太清晰")
-
-
-def parse_search_result(div: Tag):
-    result = {
-        "title": div.h3.text.strip().rstrip(" - 养老网"),
-        "date": div.select_one("span.c-showurl").string.split()[-1],
-        "abstract": div.select_one("div.c-abstract").text.strip(),
-        "href": (href := div.select_one("a")["href"])
-    }
-    if img := div.select_one("img"):
-        result["image"] = img["src"]
-    if "yanglao.com.cn/article/" in href and not href.endswith("/"):
-        result["type"] = "article"
-        result["articleId"] = int(get_id_reg.findall(href)[0])
-    elif "yanglao.com.cn/resthome/" in href and not href.endswith("/"):  # avoid /restroom
-        result["type"] = "resthome"
-        result["resthomeId"] = int(get_id_reg.findall(href)[0])
-    return result
-
-
-class GlobalSearchResults(BaseModel):
-    count: int = Field(title="搜索结果数量")
-    results: list[SearchResultItem] = Field(title="搜索结果列表",
-                                            description="这个结果是养老网用百度开放的站内搜索平台做的")
-    rawUrl: str = Field(title="搜索时用的链接", description="这个没什么用，debug时可能用得上")
+    data = parse_resthome_details(await get_html(f"/resthome/{resthome_id}.html", resthome_strainer), format)
+    index_resthome(resthome_id, data["title"], data["loc"], data["general"], next(iter(data["images"]), None))
+    upsert_resthome_details(resthome_id, data)
 
-    class Config:
-        schema_extra = {"example": {
-            "count": 2,
-            "rawUrl": "http://zhannei.baidu.com/cse/search?s=17154056689837219680&page=0&q=护理",
-            "results": [{
-                "title": "日常生活护理的注意事项_照料护理",
-                "date": "2020-3-3",
-                "abstract": "1.理解和尊重老年人,老年人有着丰富的社会经验,为社会贡献了毕生精力,为家庭做了很大贡献,同时,从生活经历而来的自我意识比较强烈。护理工作中应注意理解老年人的特点,不要伤害其尊严。在日常生活照料中,照顾者应注意在语言和行为上尊重...",
-                "type": "article",
-                "articleId": 514020,
-                "restroomId": None,
-                "href": "https://www.yanglao.com.cn/article/514020.html",
-                "image": None
-            }, {
-                "title": "居家养老护理服务详细方案(生活护理等十个方面)_照料护理",
-                "date": "2022-12-28",
-                "abstract": "一、生活护理 1. 服务内容 (1)个人卫生护理 个人卫生包括洗发、梳头、口腔清洁、洗脸、剃胡须、修剪指甲、洗手洗脚、沐浴等护理项目。 (2)生活起居护理 生活起居包括协助进食、协助排泄及如厕、协助移动、更换衣物、卧位护理等护理项目。",
-                "type": "article",
-                "articleId": 520563,
-                "restroomId": None,
-                "href": "https://www.yanglao.com.cn/article/520563.html",
-                "image": None
-            }]
-        }}
+    return data
 
 
-@router.get("/search", response_model=GlobalSearchResults)
-async def global_search(query: str = Query("", title="关键词"), page: int = Query(0, title="分页", ge=0)):
-    url = f"http://zhannei.baidu.com/cse/search?s=17154056689837219680&{page=}&q={query}"
-    dom = await get_html(url)
+def parse_cities(dom) -> dict[str, list[dict]]:
     return {
-        "count": int(get_id_reg.findall(dom.select_one("span.support-text-top").string)[0]),
-        "results": [parse_search_result(div) for div in dom.select("div.result")],
-        "rawUrl": url
+        dl.dt.text.strip(): [{"name": a.string, "regionId": a["href"].lstrip("/")} for a in dl.select("dd.list a")]
+        for dl in dom.select("div.citylist > dl")
     }
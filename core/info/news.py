@@ -1,6 +1,13 @@
-from .common import router, get_html, get_id_reg
+from .common import router, get_html, get_id_reg, SubtreeStrainer
+from .store import ArticleStore, ArticleItem, Prefetcher
+from .search import index_article
+from .compact import HtmlFormat, html_format, render_fragment
+from sqlmodel import Session, select
+from ..common.sql import engine
 from pydantic import BaseModel, Field
-from fastapi import Path, Query
+from starlette.exceptions import HTTPException
+from fastapi import Path, Query, Body, Depends
+import asyncio
 
 
 class Article(BaseModel):
@@ -48,22 +55,48 @@ class ArticleDetails(BaseModel):
         }
 
 
-@router.get("/articles", response_model=list[ArticleWithDate], responses={404: {"description": "分页超出范围"}})
-async def get_articles(page: int | None = Query(1, description="分页（从1开始）", ge=1)) -> list[ArticleWithDate]:
-    """### fetch new articles directly from the web"""
+articles_strainer = SubtreeStrainer("ul.news-list")
+article_strainer = SubtreeStrainer("div.news-view")
+
 
-    dom = await get_html(f"/article_{page}")
+def parse_articles(dom) -> list[ArticleWithDate]:
     news_list = dom.select_one("ul.news-list")
     return [ArticleWithDate(
         article_id=int(get_id_reg.findall(li.a["href"])[0]), title=li.a.string, date=li.span.string
     ) for li in news_list.find_all("li")]
 
 
-@router.get("/article/{articleId}", response_model=ArticleDetails, responses={404: {"description": "不存在该文章"}})
-async def get_article_info(article_id: int = Path(alias="articleId", description="文章唯一标识")) -> ArticleDetails:
-    """### get an article's details and its related articles"""
+async def scrape_articles(page: int) -> list[ArticleWithDate]:
+    return parse_articles(await get_html(f"/article_{page}", articles_strainer))
+
+
+articles_per_page = 20
+
+
+@router.get("/articles", response_model=list[ArticleWithDate], responses={404: {"description": "分页超出范围"}})
+async def get_articles(page: int | None = Query(1, description="分页（从1开始）", ge=1)) -> list[ArticleWithDate]:
+    """### list new articles, newest first
 
-    dom = await get_html(f"/article/{article_id}.html")
+    served from the table mirrored by the article crawler, falls back to the web when it hasn't reached this page
+    """
+
+    with Session(engine) as session:
+        items = session.exec(
+            select(ArticleItem).order_by(ArticleItem.article_id.desc())
+            .offset((page - 1) * articles_per_page).limit(articles_per_page)
+        ).all()
+
+    if len(items) < articles_per_page:
+        try:
+            return await scrape_articles(page)
+        except HTTPException as err:
+            if err.status_code < 500 or not items:
+                raise  # serve what the crawler has mirrored if the upstream is down
+
+    return [ArticleWithDate(article_id=item.article_id, title=item.title, date=item.date) for item in items]
+
+
+def parse_article(dom) -> ArticleDetails:
     news_view = dom.select_one("div.news-view")
     li_source, li_hits, li_datetime = news_view.select("ul.info > li")[:3]
     return ArticleDetails(
@@ -71,9 +104,79 @@ async def get_article_info(article_id: int = Path(alias="articleId", description
         source=li_source.string.strip()[3:],
         hits=int(li_hits.string.strip()[3:]),
         datetime=li_datetime.string.strip(),
-        html=news_view.select_one("div.news-content").prettify(),
+        html=str(news_view.select_one("div.news-content")),  # stored as is, prettified or compacted when served
         related=[
             Article(article_id=int(get_id_reg.findall(li.a["href"])[0]), title=li.a["title"])
             for li in news_view.select("div.related-read li")
         ]
     )
+
+
+async def scrape_article(article_id: int) -> ArticleDetails:
+    details = parse_article(await get_html(f"/article/{article_id}.html", article_strainer))
+    index_article(article_id, details.title, details.datetime.split()[0], details.html)
+    return details
+
+
+article_store = ArticleStore(ArticleDetails, scrape_article)
+related_prefetcher = Prefetcher(article_store)
+
+
+@router.get("/article/{articleId}", response_model=ArticleDetails, responses={404: {"description": "不存在该文章"}})
+async def get_article_info(article_id: int = Path(alias="articleId", description="文章唯一标识"),
+                           format: HtmlFormat = Depends(html_format)) -> ArticleDetails:
+    """### get an article's details and its related articles
+
+    served from the local article store, stale entries are refreshed in background,
+    and the top related articles are prefetched into it since users usually tap one of them next
+    """
+
+    details = await article_store.get(article_id)
+    related_prefetcher.schedule([article.articleId for article in details.related])
+    return formatted(details, format)
+
+
+def formatted(details: ArticleDetails, format: HtmlFormat):
+    return details.copy(update={"html": render_fragment(details.html, format)})
+
+
+max_batch_size = 50
+batch_fetching = asyncio.Semaphore(8)  # upstream fetches in flight across all batches of this worker
+
+
+async def get_bounded(article_id: int) -> ArticleDetails:
+    """`article_store.get`, waiting for a free slot of `batch_fetching` only if it may hit the upstream"""
+    if article_id in article_store.cache:
+        return await article_store.get(article_id)
+    async with batch_fetching:
+        return await article_store.get(article_id)
+
+
+class ArticleError(BaseModel):
+    status: int = Field(title="状态码", description="和单独请求`/article/{articleId}`时的状态码一致")
+    detail: str = Field(title="错误信息")
+
+
+class ArticlesBatch(BaseModel):
+    results: dict[int, ArticleDetails] = Field(title="成功的文章", description="文章id → 文章详情")
+    errors: dict[int, ArticleError] = Field(title="失败的文章", description="文章id → 错误，不影响其它文章")
+
+
+@router.post("/articles/batch", response_model=ArticlesBatch)
+async def get_articles_batch(ids: list[int] = Body(max_items=max_batch_size, example=[521502, 514020]),
+                             format: HtmlFormat = Depends(html_format)):
+    """### get many articles' details in one round trip
+
+    articles missing from the local store are fetched concurrently, a failed one only shows up in `errors`
+    """
+
+    ids = list(dict.fromkeys(ids))
+    results, errors = {}, {}
+    for article_id, result in zip(ids, await asyncio.gather(*map(get_bounded, ids), return_exceptions=True)):
+        if isinstance(result, HTTPException):
+            errors[article_id] = {"status": result.status_code, "detail": str(result.detail)}
+        elif isinstance(result, Exception):
+            errors[article_id] = {"status": 502, "detail": f"{type(result).__name__}: {result}"}
+        else:
+            results[article_id] = formatted(result, format)
+    return {"results": results, "errors": errors}
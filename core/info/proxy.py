@@ -1,10 +1,123 @@
+from ..common.disk_cache import image_cache, freshness_lifetime, Entry
+from starlette.responses import StreamingResponse, FileResponse, Response
+from starlette.background import BackgroundTask
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
 from .common import router, client
-from starlette.responses import Response
+from ..common.http import Unavailable
+from httpx import HTTPError
+from hashlib import sha256
+from uuid import uuid4
 
+forwarded_headers = ("range", "if-range", "if-none-match", "if-modified-since")
+hop_by_hop_headers = {"connection", "keep-alive", "transfer-encoding", "upgrade", "proxy-authenticate", "trailer"}
 
-@router.get("/proxy")
-async def fetch_http_resource(url):
-    response = await client.get(url, follow_redirects=True)
-    if "content-length" in response.headers:
-        del response.headers["content-length"]
-    return Response(response.content, response.status_code, response.headers)
+max_streams = 32
+streams = 0
+
+
+def cached_response(entry: Entry, request: Request):
+    if (etag := entry.headers.get("etag")) and request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=entry.headers)
+    return FileResponse(image_cache.path(entry.digest), headers=entry.headers)
+
+
+@router.get("/proxy", responses={206: {"description": "按 Range 返回的部分内容"}, 304: {"description": "未修改"},
+                                 503: {"description": "代理并发已满"}})
+async def fetch_http_resource(url, request: Request):
+    """stream an upstream resource chunk by chunk, forwarding conditional and range requests
+
+    complete `200` responses are written to the on-disk image cache while being relayed,
+    later requests are served from there as long as the upstream cache headers allow
+    """
+
+    ranged = "range" in request.headers
+    cached = None if ranged else image_cache.get(url)
+    if cached is not None and cached.fresh:
+        return cached_response(cached, request)
+
+    global streams
+    if streams >= max_streams:
+        raise HTTPException(503, f"too many proxied streams ({max_streams}), try again later", {"Retry-After": "1"})
+
+    # ask for identity encoding so that ranges and content-length refer to the bytes we pass through
+    headers = {key: value for key in forwarded_headers if (value := request.headers.get(key))}
+    headers["accept-encoding"] = "identity"
+    if cached is not None:  # stale, revalidate our copy instead of the client's
+        headers.pop("if-none-match", None)
+        headers.pop("if-modified-since", None)
+        if etag := cached.headers.get("etag"):
+            headers["if-none-match"] = etag
+        if last_modified := cached.headers.get("last-modified"):
+            headers["if-modified-since"] = last_modified
+
+    streams += 1
+    try:
+        response = await client.send(client.build_request("GET", url, headers=headers), stream=True,
+                                     follow_redirects=True)
+    except Unavailable as err:
+        streams -= 1
+        raise HTTPException(503, str(err))
+    except HTTPError as err:
+        streams -= 1
+        raise HTTPException(502, f"{type(err).__name__}: {err}")
+    except BaseException:
+        streams -= 1
+        raise
+
+    closed = False
+
+    async def close():
+        nonlocal closed
+        global streams
+        if not closed:
+            closed = True
+            streams -= 1
+            await response.aclose()
+
+    async def relay(chunks):
+        # starlette skips background tasks when the body raises, so the slot is given back here too
+        try:
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            await close()
+
+    async def relay_and_store():
+        digest = sha256()
+        file = image_cache.temp_path(uuid4().hex)
+        try:
+            with file.open("wb") as f:
+                async for chunk in response.aiter_raw():
+                    f.write(chunk)
+                    digest.update(chunk)
+                    yield chunk
+            image_cache.put_file(url, file, digest.hexdigest(), response.headers)
+        finally:
+            file.unlink(missing_ok=True)
+
+    try:
+        if cached is not None and response.status_code == 304:
+            await close()
+            image_cache.revalidated(url, response.headers)
+            return cached_response(cached, request)
+
+        length = response.headers.get("content-length", "0")
+        cacheable = (response.status_code == 200 and not ranged and
+                     freshness_lifetime(response.headers, image_cache.default_ttl) is not None and
+                     length.isdigit() and int(length) <= image_cache.max_item_size)
+
+        return StreamingResponse(
+            relay(relay_and_store() if cacheable else response.aiter_raw()), response.status_code,
+            background=BackgroundTask(close),  # a client disconnecting midway stops the body without raising
+            headers={key: value for key, value in response.headers.items() if key not in hop_by_hop_headers}
+        )
+    except BaseException:
+        await close()
+        raise
+
+
+@router.get("/cache_stats", tags=["dev"])
+def get_cache_stats():
+    """hits, misses and evictions of the on-disk image cache"""
+    return image_cache.report()
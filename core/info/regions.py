@@ -0,0 +1,178 @@
+from .homes import Region, parse_cities, parse_resthomes, cities_strainer, resthomes_strainer
+from starlette.exceptions import HTTPException
+from pydantic import Field
+from datetime import datetime, timedelta
+from starlette.responses import Response
+from .common import router, get_html
+from ..common.leader import Leader, leaders
+from fastapi import Path as PathParam
+from orjson import dumps, loads
+from pathlib import Path
+from os import getpid
+import asyncio
+
+
+class RegionTree:
+    """province → city → district tree of region ids, persisted to disk and rebuilt every `period`
+
+    unknown region ids are only rejected while `complete`, i.e. after a build that listed every city,
+    an incomplete build is retried after `period / 24` instead of after a whole `period`
+
+    only the `leader` builds, the other workers reload `path` whenever it has changed, checking every `check` seconds
+
+    `/cities` is served from `cities_json`, serialized once per change instead of once per request
+    """
+
+    attempt_key = "regions:attempt"  # held for `period / 24` after a build starts, so a failing one isn't rushed
+
+    def __init__(self, path: Path, period=timedelta(days=7), interval=2.0, check=60.0):
+        self.path = path
+        self.period = period
+        self.interval = interval
+        self.check = check
+        self.leader = Leader("regions:leader")
+        self.loaded_mtime: float | None = None
+        self.nodes: dict[str, dict] = {}  # regionId -> {"name", "regionId", "parent", "children"}
+        self.provinces: dict[str, list[str]] = {}  # province name -> city ids, in page order
+        self.built_at: datetime | None = None
+        self.complete = False
+        self.cities_json = b"{}"
+        self.task: asyncio.Task | None = None
+
+    def __contains__(self, region_id: str):
+        return region_id in self.nodes
+
+    def region(self, region_id: str):
+        return {"name": self.nodes[region_id]["name"], "regionId": region_id}
+
+    def set_cities(self, cities: dict[str, list[dict]]):
+        for province, regions in cities.items():
+            self.provinces[province] = [region["regionId"] for region in regions]
+            for region in regions:
+                node = self.nodes.setdefault(region["regionId"], {"children": []})
+                node |= {"name": region["name"], "regionId": region["regionId"], "parent": None}
+        self.serialize()
+
+    def serialize(self):
+        self.cities_json = dumps({
+            province: [self.region(region_id) for region_id in region_ids]
+            for province, region_ids in self.provinces.items()
+        })
+
+    def is_city(self, region_id: str):
+        return region_id in self.nodes and self.nodes[region_id]["parent"] is None
+
+    def set_children(self, parent_id: str, sub_regions: list[dict]):
+        """record a city's districts, as listed in the filter bar of its resthome listing"""
+        if not self.is_city(parent_id):
+            return  # only cities have districts, a district page lists its siblings
+        children = [region for region in sub_regions if not self.is_city(region["regionId"])]
+        for region in children:
+            self.nodes[region["regionId"]] = {
+                "name": region["name"], "regionId": region["regionId"], "parent": parent_id, "children": []
+            }
+        self.nodes[parent_id]["children"] = [region["regionId"] for region in children]
+
+    async def build(self):
+        self.set_cities(parse_cities(await get_html("/city", cities_strainer)))
+        failed = []
+        for city_id in [city_id for city_ids in self.provinces.values() for city_id in city_ids]:
+            await asyncio.sleep(self.interval)
+            if not self.leader.lead():
+                raise RuntimeError("lost the region tree lock to another worker")
+            try:
+                dom = await get_html(f"/{city_id}_1", resthomes_strainer)
+            except HTTPException as err:
+                failed.append(city_id)
+                print(f"failed to list the districts of {city_id}: {err.status_code} {err.detail}")
+                continue
+            self.set_children(city_id, parse_resthomes(dom)["subRegions"])
+        self.built_at = datetime.utcnow()
+        # districts of a skipped city may be missing, and an empty sitemap would make every region look unknown
+        self.complete = bool(self.nodes) and not failed
+        self.save()
+
+    async def run(self):
+        while True:
+            self.reload()
+            if (not self.complete or datetime.utcnow() - self.built_at > self.period) and self.leader.lead():
+                try:
+                    if leaders.set(self.attempt_key, getpid(), nx=True, ex=self.period / 24):
+                        await self.build()
+                except Exception as err:
+                    print(f"failed to build region tree: {err!r}")
+                finally:
+                    self.leader.resign()
+            await asyncio.sleep(self.check)
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.leader.resign()
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(f".{getpid()}.tmp")  # a worker loading meanwhile must not see half of it
+        tmp.write_bytes(dumps({
+            "nodes": self.nodes, "provinces": self.provinces, "builtAt": self.built_at, "complete": self.complete
+        }))
+        tmp.replace(self.path)
+        self.loaded_mtime = self.path.stat().st_mtime
+
+    def reload(self):
+        """load the tree another worker has saved since"""
+        try:
+            mtime = self.path.stat().st_mtime
+        except FileNotFoundError:
+            return
+        if mtime != self.loaded_mtime:
+            self.load()
+
+    def load(self):
+        try:
+            if self.path.is_file():
+                self.loaded_mtime = self.path.stat().st_mtime
+                data = loads(self.path.read_bytes())
+                built_at = data["builtAt"] and datetime.fromisoformat(data["builtAt"])
+                self.nodes, self.provinces, self.complete = data["nodes"], data["provinces"], data["complete"]
+                self.built_at = built_at
+                self.serialize()
+        except Exception as err:  # left incomplete, so it's rebuilt
+            print(f"failed to load {self.path}: {err!r}")
+        return self
+
+
+region_tree = RegionTree(Path("data/regions.json")).load()
+
+
+@router.get("/cities", response_model=dict[str, list[Region]])
+async def get_cities():
+    """sitemap from https://www.yanglao.com.cn/city"""
+    if not region_tree.provinces:
+        region_tree.set_cities(parse_cities(await get_html("/city", cities_strainer)))
+    return Response(region_tree.cities_json, media_type="application/json")
+
+
+class RegionDetails(Region):
+    parent: Region | None = Field(title="上级地区", description="城市没有上级地区")
+    children: list[Region] = Field(title="下级地区", description="区县没有下级地区")
+
+
+@router.get("/regions/{regionId}", response_model=RegionDetails, responses={404: {"description": "不存在该地区"}})
+def get_region(region_id: str = PathParam(alias="regionId")):
+    if region_id not in region_tree:
+        raise HTTPException(404, f"region {region_id} not found")
+    node = region_tree.nodes[region_id]
+    return {
+        **region_tree.region(region_id),
+        "parent": node["parent"] and region_tree.region(node["parent"]),
+        "children": [region_tree.region(child_id) for child_id in node["children"]]
+    }
@@ -0,0 +1,255 @@
+from .store import ArticleItem, ArticleDetailsItem
+from collections import Counter, defaultdict
+from sqlmodel import Session, select
+from ..common.sql import engine
+from pydantic import BaseModel, Field
+from .common import router, sub_str_reg
+from urllib.parse import urlencode
+from html import unescape
+from ujson import loads
+from fastapi import Query
+from pathlib import Path
+from os import getpid
+from math import log
+from enum import Enum
+import asyncio
+import pickle
+import re
+
+token_reg = re.compile(r"[\u3400-\u9fff\uf900-\ufaff]+|[a-z0-9]+")
+tag_reg = re.compile(r"<[^>]+>")
+
+
+def tokenize(text: str):
+    """ascii words as they are, chinese runs as character unigrams and bigrams"""
+    for run in token_reg.findall(text.lower()):
+        if run.isascii():
+            yield run
+        else:
+            yield from run
+            yield from map("".join, zip(run, run[1:]))
+
+
+def html_to_text(html: str):
+    return sub_str_reg.sub(" ", unescape(tag_reg.sub(" ", html))).strip()
+
+
+class SearchIndex:
+    """in-process inverted index ranked with BM25, pickled to disk so restarts don't rebuild it
+
+    every worker keeps its own index, saving merges in the documents the others have saved meanwhile
+    """
+
+    k1 = 1.5
+    b = 0.75
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.docs: dict[tuple[str, int], dict] = {}
+        self.terms: dict[tuple[str, int], Counter] = {}
+        self.postings: defaultdict[str, dict[tuple[str, int], int]] = defaultdict(dict)
+        self.total_length = 0
+        self.dirty = False
+
+    def __contains__(self, key):
+        return key in self.docs
+
+    def add(self, key: tuple[str, int], title: str, body: str = "", **fields):
+        terms = Counter(tokenize(title))
+        terms.update(terms)  # title terms weigh double
+        terms.update(tokenize(body))
+        self.insert(key, terms, {"title": title, "abstract": body[:120]} | fields)
+        self.dirty = True
+
+    def insert(self, key: tuple[str, int], terms: Counter, doc: dict):
+        self.remove(key)
+        for term, tf in terms.items():
+            self.postings[term][key] = tf
+        self.terms[key] = terms
+        self.docs[key] = doc
+        self.total_length += terms.total()
+
+    def remove(self, key: tuple[str, int]):
+        if (terms := self.terms.pop(key, None)) is None:
+            return
+        for term in terms:
+            postings = self.postings[term]
+            del postings[key]
+            if not postings:
+                del self.postings[term]
+        del self.docs[key]
+        self.total_length -= terms.total()
+        self.dirty = True
+
+    async def search(self, query: str, offset=0, limit=10):
+        if not self.docs:
+            return 0, []
+
+        # copying the posting lists is cheap, scoring them is not and happens off the event loop
+        postings = [list(postings.items()) for term in set(tokenize(query)) if (postings := self.postings.get(term))]
+        return await asyncio.to_thread(self.rank, postings, len(self.docs), self.total_length / len(self.docs),
+                                       offset, limit)
+
+    def rank(self, postings: list[list[tuple[tuple[str, int], int]]], n: int, avg_length: float, offset: int,
+             limit: int):
+        scores = Counter()
+        for items in postings:
+            idf = log(1 + (n - len(items) + 0.5) / (len(items) + 0.5))
+            for key, tf in items:
+                if (terms := self.terms.get(key)) is None:
+                    continue  # replaced meanwhile
+                length = terms.total()
+                scores[key] += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / avg_length))
+
+        ranked = scores.most_common(offset + limit)[offset:]
+        return len(scores), [doc for key, _ in ranked if (doc := self.docs.get(key)) is not None]
+
+    def snapshot(self):
+        # shallow copies are enough, documents are replaced as a whole and never modified in place
+        return dict(self.docs), dict(self.terms)
+
+    def read(self) -> tuple[dict, dict]:
+        if not self.path.is_file():
+            return {}, {}
+        with self.path.open("rb") as f:
+            docs, terms, *_ = pickle.load(f)  # files of older versions also hold the postings
+        return docs, terms
+
+    def write(self, docs: dict, terms: dict):
+        """write `docs` merged with the ones other workers have saved, return those not in `docs`"""
+        try:
+            saved_docs, saved_terms = self.read()
+        except Exception as err:
+            print(f"overwriting unreadable {self.path}: {err!r}")
+            saved_docs, saved_terms = {}, {}
+        others = {key: (saved_terms[key], doc) for key, doc in saved_docs.items() if key not in docs}
+        for key, (doc_terms, doc) in others.items():
+            docs[key], terms[key] = doc, doc_terms
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(f".{getpid()}.tmp")  # workers must not write into each other's file
+        with tmp.open("wb") as f:
+            pickle.dump((docs, terms), f, pickle.HIGHEST_PROTOCOL)
+        tmp.replace(self.path)
+        return others
+
+    async def save(self):
+        self.dirty = False
+        others = await asyncio.to_thread(self.write, *self.snapshot())
+        for key, (terms, doc) in others.items():
+            if key not in self.docs:
+                self.insert(key, terms, doc)
+
+    def load(self):
+        try:
+            docs, terms = self.read()
+        except Exception as err:  # the lifespan rebuilds an empty index from the database
+            print(f"failed to load {self.path}: {err!r}")
+            return self
+        for key, doc in docs.items():
+            self.insert(key, terms[key], doc)
+        return self
+
+    async def autosave(self, interval=300.0):
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                if self.dirty:
+                    await self.save()
+        finally:
+            if self.dirty:
+                self.write(*self.snapshot())
+
+
+index = SearchIndex(Path("data/search.pickle")).load()
+
+
+def index_article(article_id: int, title: str, date: str, html: str = None):
+    key = ("article", article_id)
+    if html is None and key in index:
+        return  # keep the indexed body of a fully fetched article
+    index.add(key, title, html_to_text(html) if html else "", date=date, type="article", articleId=article_id,
+              href=f"https://www.yanglao.com.cn/article/{article_id}.html")
+
+
+def index_resthome(resthome_id: int, title: str, loc: str, details: str = None, image: str = None):
+    key = ("resthome", resthome_id)
+    if details is None and key in index:
+        return
+    index.add(key, title, f"{loc} {details or ''}".strip(), date="", type="resthome", restroomId=resthome_id,
+              href=f"https://www.yanglao.com.cn/resthome/{resthome_id}.html", image=image)
+
+
+def rebuild_index():
+    """index whatever the article and resthome tables already hold, used when there is no usable index file"""
+    from .catalog import ResthomeItem
+
+    with Session(engine) as session:
+        for item in session.exec(select(ArticleItem)):
+            index_article(item.article_id, item.title, item.date)
+        for item in session.exec(select(ArticleDetailsItem)):
+            details = loads(item.content)
+            index_article(item.article_id, details["title"], details["datetime"].split()[0], details["html"])
+        for item in session.exec(select(ResthomeItem)):
+            index_resthome(item.resthome_id, item.title, item.loc, item.general, item.image)
+
+
+class ResultType(Enum):
+    article = "article"
+    resthome = "resthome"
+
+
+class SearchResultItem(BaseModel):
+    title: str = Field(title="网页标题")
+    date: str = Field(title="日期", description="yyyy-dd-mm 格式，机构没有日期则为空字符串")
+    abstract: str = Field(title="摘要", description="正文或机构信息的开头部分")
+    type: ResultType | None = Field(title="结果类型",
+                                    description="如果是文章链接则有文章id，如果是机构链接的话则有机构id")
+    article_id: int | None = Field(alias="articleId", title="文章id",
+                                   description="如果是文章的话有，可以用来进入文章详情页")
+    restroom_id: int | None = Field(alias="restroomId", title="机构id",
+                                    description="如果是机构的话有，可以用来进入机构详情页")
+    href: str = Field(title="搜索结果的原始网页链接",
+                      description="养老网上对应的网页链接，不管是不是文章或者机构都有")
+    image: str | None = Field(title="网页图片", description="只有机构可能有")
+
+
+class GlobalSearchResults(BaseModel):
+    count: int = Field(title="搜索结果数量")
+    results: list[SearchResultItem] = Field(title="搜索结果列表",
+                                            description="在本地收录的文章和机构上做的全文检索，按 BM25 相关度排序")
+    rawUrl: str = Field(title="搜索时用的链接", description="这个没什么用，debug时可能用得上")
+
+    class Config:
+        schema_extra = {"example": {
+            "count": 2,
+            "rawUrl": "/search?query=护理&page=0",
+            "results": [{
+                "title": "日常生活护理的注意事项_照料护理",
+                "date": "2020-3-3",
+                "abstract": "1.理解和尊重老年人,老年人有着丰富的社会经验,为社会贡献了毕生精力,为家庭做了很大贡献,同时,从生活经历而来的自我意识比较强烈。护理工作中应注意理解老年人的特点,不要伤害其尊严。在日常生活照料中,照顾者应注意在语言和行为上尊重...",
+                "type": "article",
+                "articleId": 514020,
+                "restroomId": None,
+                "href": "https://www.yanglao.com.cn/article/514020.html",
+                "image": None
+            }, {
+                "title": "居家养老护理服务详细方案(生活护理等十个方面)_照料护理",
+                "date": "2022-12-28",
+                "abstract": "一、生活护理 1. 服务内容 (1)个人卫生护理 个人卫生包括洗发、梳头、口腔清洁、洗脸、剃胡须、修剪指甲、洗手洗脚、沐浴等护理项目。 (2)生活起居护理 生活起居包括协助进食、协助排泄及如厕、协助移动、更换衣物、卧位护理等护理项目。",
+                "type": "article",
+                "articleId": 520563,
+                "restroomId": None,
+                "href": "https://www.yanglao.com.cn/article/520563.html",
+                "image": None
+            }]
+        }}
+
+
+results_per_page = 10
+
+
+@router.get("/search", response_model=GlobalSearchResults)
+async def global_search(query: str = Query("", title="关键词"), page: int = Query(0, title="分页", ge=0)):
+    count, results = await index.search(query, page * results_per_page, results_per_page)
+    return {"count": count, "results": results, "rawUrl": f"/search?{urlencode({'query': query, 'page': page})}"}
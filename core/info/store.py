@@ -0,0 +1,148 @@
+from sqlmodel import SQLModel, Field, Session
+from sqlalchemy.dialects.mysql import MEDIUMTEXT
+from datetime import datetime, timedelta
+from sqlalchemy import Column, Text
+from sqlalchemy.exc import IntegrityError
+from cachetools import LRUCache
+from ..common.sql import engine
+from .common import in_flight
+from pydantic import BaseModel
+from functools import partial
+from hashlib import md5
+import asyncio
+
+
+class ArticleItem(SQLModel, table=True):
+    __tablename__ = "articles"
+    article_id: int = Field(primary_key=True, sa_column_kwargs={"autoincrement": False})
+    title: str
+    date: str = Field(max_length=10)
+
+
+class ArticleDetailsItem(SQLModel, table=True):
+    __tablename__ = "article_details"
+    article_id: int = Field(primary_key=True, sa_column_kwargs={"autoincrement": False})
+    fetched_at: datetime
+    content_hash: str = Field(max_length=32)
+    content: str = Field(sa_column=Column(Text().with_variant(MEDIUMTEXT(), "mysql"), nullable=False))
+
+
+def write_details(session: Session, article_id: int, content: str, content_hash: str, fetched_at: datetime):
+    if (item := session.get(ArticleDetailsItem, article_id)) is None:
+        item = ArticleDetailsItem(article_id=article_id, content=content, content_hash=content_hash,
+                                  fetched_at=fetched_at)
+    elif item.content_hash != content_hash:
+        item.content, item.content_hash, item.fetched_at = content, content_hash, fetched_at
+    else:
+        item.fetched_at = fetched_at
+    session.add(item)
+    session.commit()
+
+
+class ArticleStore:
+    """parsed articles persisted in `article_details`, with hot ids kept in an in-process LRU
+
+    entries older than `fresh_for` are still served, while a background refresh re-scrapes them
+    """
+
+    def __init__(self, model: type[BaseModel], fetch, fresh_for=timedelta(hours=6), maxsize=512):
+        self.model = model
+        self.fetch = fetch
+        self.fresh_for = fresh_for
+        self.cache = LRUCache(maxsize)
+        self.refreshing: dict[int, asyncio.Task] = {}
+
+    def lookup(self, article_id: int) -> tuple[datetime, BaseModel] | None:
+        """the stored `(fetched_at, details)` however old, never fetching"""
+        if (hit := self.cache.get(article_id)) is None:
+            with Session(engine) as session:
+                item = session.get(ArticleDetailsItem, article_id)
+            if item is None:
+                return None
+            hit = self.cache[article_id] = item.fetched_at, self.model.parse_raw(item.content)
+        return hit
+
+    async def get(self, article_id: int):
+        if (hit := self.lookup(article_id)) is None:
+            return await self.refresh(article_id)
+
+        fetched_at, details = hit
+        if datetime.utcnow() - fetched_at > self.fresh_for:
+            self.revalidate(article_id)
+        return details
+
+    async def refresh(self, article_id: int):
+        details = await self.fetch(article_id)
+        self.save(article_id, details)
+        return details
+
+    def revalidate(self, article_id: int):
+        if article_id in self.refreshing:
+            return
+
+        def done(task: asyncio.Task):
+            del self.refreshing[article_id]
+            if not task.cancelled() and (err := task.exception()) is not None:
+                print(f"failed to refresh article {article_id}: {err!r}")
+
+        self.refreshing[article_id] = task = asyncio.create_task(self.refresh(article_id))
+        task.add_done_callback(done)
+
+    def save(self, article_id: int, details: BaseModel):
+        content = details.json(by_alias=True, ensure_ascii=False)
+        content_hash = md5(content.encode()).hexdigest()
+        fetched_at = datetime.utcnow()
+
+        with Session(engine) as session:
+            try:
+                write_details(session, article_id, content, content_hash, fetched_at)
+            except IntegrityError:  # another worker inserted it after our lookup, update that row instead
+                session.rollback()
+                write_details(session, article_id, content, content_hash, fetched_at)
+
+        self.cache[article_id] = fetched_at, details
+
+
+class Prefetcher:
+    """warms `store` with ids the user is likely to open next, using spare upstream capacity only
+
+    at most `budget` prefetches run at once, and none is started while `busy_threshold` upstream fetches
+    are in flight, so foreground requests never queue behind them. a prefetch that has already
+    started is let finish, cancelling it would waste the fetch without stopping it
+    """
+
+    def __init__(self, store: ArticleStore, top_k=3, budget=4, busy_threshold=16):
+        self.store = store
+        self.top_k = top_k
+        self.budget = budget
+        self.busy_threshold = busy_threshold
+        self.tasks: dict[int, asyncio.Task] = {}
+
+    @property
+    def busy(self):
+        return len(in_flight) >= self.busy_threshold
+
+    def schedule(self, article_ids: list[int]):
+        if self.busy:
+            return
+
+        for article_id in article_ids[:self.top_k]:
+            if len(self.tasks) >= self.budget:
+                break
+            if article_id in self.store.cache or article_id in self.tasks or article_id in self.store.refreshing:
+                continue
+            self.tasks[article_id] = task = asyncio.create_task(self.prefetch(article_id))
+            task.add_done_callback(partial(self.done, article_id))
+
+    def done(self, article_id: int, task: asyncio.Task):
+        del self.tasks[article_id]
+        if not task.cancelled():
+            task.exception()  # a failed prefetch costs nothing but the attempt, mark it retrieved
+
+    async def prefetch(self, article_id: int):
+        await asyncio.sleep(0)  # let the response that triggered us go out first
+        if not self.busy:  # the last chance to back off, from here on the result is stored
+            await self.store.get(article_id)
+
+
+__all__ = ["ArticleItem", "ArticleDetailsItem", "ArticleStore", "Prefetcher"]
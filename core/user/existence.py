@@ -0,0 +1,121 @@
+from redis import Redis, RedisError
+from ..common.secret import pool
+from collections import Counter
+from cachetools import TLRUCache
+from threading import Lock
+
+
+class ExistenceCache:
+    """whether a user id exists, cached in process and in redis, negative answers included
+
+    `invalidate` overwrites the redis entry and tells every worker through pub/sub to drop its local one,
+    local entries also expire after `local_ttl`, negative ones after `local_negative_ttl`, in case a message is missed
+    (a user who just registered mustn't look missing for long).
+    other per-user caches hook into the same messages with `on_invalidate` and send them with `publish`
+    """
+
+    channel = "users:invalidate"
+
+    def __init__(self, load, redis: Redis, maxsize=8192, local_ttl=300, local_negative_ttl=5, ttl=86400,
+                 negative_ttl=60):
+        self.load = load
+        self.redis = redis
+        self.local = TLRUCache(maxsize, lambda _, exists, now: now + (local_ttl if exists else local_negative_ttl))
+        self.lock = Lock()  # sync endpoints call this from the threadpool
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stats = Counter(local_hits=0, redis_hits=0, loads=0, invalidations=0)
+        self.subscriber = None
+        self.listeners = [self.drop]
+        self.drops = 0  # local entries dropped so far, a lookup racing with a drop doesn't store its answer
+
+    @staticmethod
+    def key(user_id: str):
+        return f"users:exist:{user_id}"
+
+    def __call__(self, user_id: str) -> bool:
+        with self.lock:
+            if (exists := self.local.get(user_id)) is not None:
+                self.stats["local_hits"] += 1
+                return exists
+            drops = self.drops
+
+        try:
+            cached = self.redis.get(self.key(user_id))
+        except RedisError as err:
+            print(err)
+            cached = None
+        if cached is not None:
+            self.stats["redis_hits"] += 1
+            exists = cached == b"1"
+        else:
+            self.stats["loads"] += 1
+            exists = self.load(user_id)
+            try:
+                # only fill in a missing entry, `invalidate` may have written a newer answer since the load
+                if not self.redis.set(self.key(user_id), int(exists), self.ttl if exists else self.negative_ttl,
+                                      nx=True) and (cached := self.redis.get(self.key(user_id))) is not None:
+                    exists = cached == b"1"
+            except RedisError as err:
+                print(err)
+
+        with self.lock:
+            if self.drops == drops:  # otherwise the answer may predate an invalidation, don't keep it
+                self.local[user_id] = exists
+        return exists
+
+    def drop(self, user_id: str):
+        with self.lock:
+            self.local.pop(user_id, None)
+            self.drops += 1
+
+    def on_invalidate(self, listener):
+        """call `listener(user_id)` whenever any worker publishes a change of that user"""
+        self.listeners.append(listener)
+
+    def received(self, user_id: str):
+        for listener in self.listeners:
+            try:
+                listener(user_id)
+            except Exception as err:
+                print(f"failed to invalidate user {user_id}: {err!r}")
+
+    def publish(self, user_id: str):
+        """drop what this and every other worker caches about `user_id`"""
+        self.received(user_id)
+        try:
+            self.redis.publish(self.channel, user_id)
+        except RedisError as err:
+            print(err)
+
+    def invalidate(self, user_id: str, exists: bool):
+        """record that `user_id` now does or doesn't exist, overwriting whatever a racing lookup has cached"""
+        self.stats["invalidations"] += 1
+        try:
+            self.redis.set(self.key(user_id), int(exists), self.ttl if exists else self.negative_ttl)
+        except RedisError as err:
+            print(err)
+        self.publish(user_id)
+
+    def start(self):
+        if self.subscriber is None:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(**{self.channel: lambda message: self.received(message["data"].decode())})
+            except RedisError as err:
+                print(f"not listening for user invalidations, relying on local_ttl and local_negative_ttl: {err!r}")
+                return
+            self.subscriber = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def stop(self):
+        if self.subscriber is not None:
+            self.subscriber.stop()
+            self.subscriber = None
+
+    def report(self):
+        lookups = sum(self.stats[key] for key in ("local_hits", "redis_hits", "loads"))
+        return dict(self.stats, entries=len(self.local),
+                    hit_rate=lookups and round((lookups - self.stats["loads"]) / lookups, 4))
+
+
+users_cache = Redis(connection_pool=pool)
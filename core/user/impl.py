@@ -1,26 +1,29 @@
-from sqlmodel import SQLModel, Field, Session, select, or_
+from sqlmodel import SQLModel, Field, Session, select, or_, func
 from starlette.responses import PlainTextResponse
 from ..common.secret import app_secret_1 as sk_1
 from starlette.exceptions import HTTPException
 from fastapi.responses import ORJSONResponse
-from sqlalchemy.exc import NoResultFound
-from fastapi import APIRouter, Depends
-from cachetools.func import ttl_cache
-from ..common.auth import Bearer
+from sqlalchemy.exc import NoResultFound, IntegrityError
+from cachetools import TTLCache
+from sqlmodel import delete
+from sqlalchemy import update
+from fastapi import APIRouter, Depends, Query
+from .existence import ExistenceCache, users_cache
+from ..common.auth import Bearer, forget_tokens
 from functools import lru_cache
 from ujson import dumps, loads
 from pydantic import BaseModel
-from httpx import AsyncClient
-from itertools import chain
+from ..common.http import default as client
+from contextvars import ContextVar
 from ..common.sql import *
 from fastapi import Form
+from threading import Lock
 from hashlib import md5
+import asyncio
 import jwt
 
 router = APIRouter(tags=["user"])
 
-client = AsyncClient(http2=True)
-
 
 def md5_hash(string: str) -> bytes:
     return md5(string.encode()).digest()
@@ -31,7 +34,71 @@ class UserItem(SQLModel, table=True):
     id: str = Field(None, nullable=False, primary_key=True)
     pwd_hash: bytes
     meta: str = "{}"
-    permission: str = ""
+    meta_version: int | None = 0  # bumped by every meta write, for compare-and-set updates
+    permission: str = ""  # legacy space-separated grantees, moved into `permissions` by `migrate_permissions`
+
+
+class PermissionItem(SQLModel, table=True):
+    """`grantee_id` may view the data of `grantor_id`"""
+    __tablename__ = "permissions"
+    grantor_id: str = Field(foreign_key="users.id", primary_key=True)
+    grantee_id: str = Field(foreign_key="users.id", primary_key=True, index=True)
+
+
+# grantor id -> ids of who it permitted, every worker drops an entry when the grantor's permissions change,
+# see `drop_permitted`, entries also expire in case such a message is missed
+permitted_cache: TTLCache = TTLCache(4096, 60)
+permitted_lock = Lock()  # used from the threadpool and the invalidation subscriber
+permitted_drops = 0  # a load that raced with any drop is not cached, it may predate the change
+
+
+def permitted_viewers(owner_id: str) -> frozenset[str]:
+    with permitted_lock:
+        if (viewers := permitted_cache.get(owner_id)) is not None:
+            return viewers
+        drops = permitted_drops
+    with Session(engine) as session:
+        viewers = frozenset(session.exec(
+            select(PermissionItem.grantee_id).where(PermissionItem.grantor_id == owner_id)
+        ))
+    with permitted_lock:
+        if permitted_drops == drops:
+            permitted_cache[owner_id] = viewers
+    return viewers
+
+
+def drop_permitted(owner_id: str):
+    global permitted_drops
+    with permitted_lock:
+        permitted_cache.pop(owner_id, None)
+        permitted_drops += 1
+
+
+def permitted_by(viewer_id: str, owner_ids) -> set[str]:
+    """which of `owner_ids` let `viewer_id` view their data, in a single query"""
+    owner_ids = set(owner_ids)
+    permitted = {viewer_id} & owner_ids
+    if pending := owner_ids - permitted:
+        with Session(engine) as session:
+            permitted.update(session.exec(select(PermissionItem.grantor_id).where(
+                PermissionItem.grantee_id == viewer_id, PermissionItem.grantor_id.in_(pending)
+            )))
+    return permitted
+
+
+def migrate_permissions():
+    with Session(engine) as session:
+        items = session.exec(select(UserItem).where(UserItem.permission != "")).all()
+        known = set(session.exec(select(UserItem.id)))
+        for item in items:
+            for grantee_id in set(item.permission.split()) & known:
+                if session.get(PermissionItem, (item.id, grantee_id)) is None:
+                    session.add(PermissionItem(grantor_id=item.id, grantee_id=grantee_id))
+            item.permission = ""
+            session.add(item)
+        session.commit()
+    with permitted_lock:
+        permitted_cache.clear()
 
 
 class PwdChecker:
@@ -56,11 +123,36 @@ class PwdChecker:
         return self.Checker(instance.item.pwd_hash)
 
     def __set__(self, instance: "User", value: str):
+        pwd_hash = md5_hash(value)
         with Session(engine) as session:
-            instance.item.pwd_hash = md5_hash(value)
-            session.add(instance.item)
+            session.exec(update(UserItem).where(UserItem.id == instance.id).values(pwd_hash=pwd_hash))
             session.commit()
-            session.refresh(instance.item)
+        instance.item.pwd_hash = pwd_hash
+        existence.publish(instance.id)  # cached tokens of this user, on every worker
+
+
+# user id -> (row, decoded meta), loaded at most once per request, None outside of requests
+loaded_users: ContextVar[dict[str, tuple[UserItem, dict]] | None] = ContextVar("loaded_users", default=None)
+
+
+def copy_loaded(hit: tuple[UserItem, dict]) -> tuple[UserItem, dict]:
+    """a private copy of a loaded user, requests modify theirs in place"""
+    item, meta = hit
+    return UserItem(**item.dict()), dict(meta)
+
+
+class IdentityMapMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        token = loaded_users.set({})
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            loaded_users.reset(token)
 
 
 # noinspection PyPropertyAccess
@@ -74,25 +166,60 @@ class User:
         return self.meta.get(key)
 
     def __setitem__(self, key, val):
-        (meta := self.meta)[key] = val
-        with Session(engine) as session:
-            item = self.item
-            item.meta = dumps(meta, ensure_ascii=False)
-            session.add(item)
-            session.commit()
+        self.update_meta({key: val})
+
+    def update_meta(self, changes: dict, retries=5) -> dict:
+        """merge `changes` into meta with a compare-and-set on `meta_version`
+
+        a concurrent write makes the update match no row, then it's reapplied on top of the fresh meta,
+        so parallel edits of different fields all survive
+        """
+        item, meta = self.load()
+        for _ in range(retries):
+            meta, version = {**meta, **changes}, item.meta_version or 0
+            with Session(engine) as session:
+                result = session.exec(update(UserItem).where(
+                    UserItem.id == self.id, func.coalesce(UserItem.meta_version, 0) == version
+                ).values(meta=dumps(meta, ensure_ascii=False), meta_version=version + 1))
+                session.commit()
+            if result.rowcount:
+                break
+            self.forget()
+            item, meta = self.load()
+        else:
+            raise HTTPException(409, f"{self!r} is being edited concurrently, try again later")
+
+        item.meta, item.meta_version = dumps(meta, ensure_ascii=False), version + 1
+        if (loaded := loaded_users.get()) is not None:
+            loaded[self.id] = item, meta
+        existence.publish(self.id)  # tokens of this user, on every worker, hold their own snapshots
+        return meta
 
     @property
     def meta(self) -> dict:
-        return loads(self.item.meta)
+        return self.load()[1]
 
     @property
     def permissions(self) -> list:
-        return [self.id] + self.item.permission.split()
+        return [self.id, *sorted(permitted_viewers(self.id))]
 
     @property
-    def item(self):
+    def item(self) -> UserItem:
+        return self.load()[0]
+
+    def load(self):
+        if (loaded := loaded_users.get()) is not None and (hit := loaded.get(self.id)) is not None:
+            return hit
         with Session(engine) as session:
-            return session.exec(select(UserItem).where(UserItem.id == self.id)).one()
+            item = session.exec(select(UserItem).where(UserItem.id == self.id)).one()
+        hit = item, loads(item.meta)
+        if loaded is not None:
+            loaded[self.id] = hit
+        return hit
+
+    def forget(self):
+        if (loaded := loaded_users.get()) is not None:
+            loaded.pop(self.id, None)
 
     def __repr__(self):
         return f"User({self.id})"
@@ -114,39 +241,44 @@ def get_permissions(bearer: Bearer = Depends()):
 
 @router.put("/permission", response_class=PlainTextResponse)
 def add_permission(from_user_id: str = Depends(ensure), to_bearer: Bearer = Depends()):
-    if from_user_id in to_bearer.user.permissions:
+    try:
+        with Session(engine) as session:
+            session.add(PermissionItem(grantor_id=to_bearer.id, grantee_id=from_user_id))
+            session.commit()
+    except IntegrityError:  # the primary key makes concurrent grants of the same pair collide here
         return f"{User(from_user_id)} already in {to_bearer.user}'s permission list"
-
-    to_user_item = to_bearer.user.item
-    with Session(engine) as session:
-        to_user_item.permission = " ".join(to_user_item.permission.split() + [from_user_id])
-        session.add(to_user_item)
-        session.commit()
-        return f"add {User(from_user_id)} to {to_bearer.user}'s permission list successfully"
+    finally:
+        existence.publish(to_bearer.id)
+    return f"add {User(from_user_id)} to {to_bearer.user}'s permission list successfully"
 
 
 @router.delete("/permission", response_class=PlainTextResponse)
 async def remove_permission(from_user_id: str = Depends(ensure), to_bearer: Bearer = Depends()):
-    permission = to_bearer.user.item.permission
+    with Session(engine) as session:
+        result = session.exec(delete(PermissionItem).where(
+            PermissionItem.grantor_id == to_bearer.id, PermissionItem.grantee_id == from_user_id
+        ))
+        session.commit()
+    existence.publish(to_bearer.id)  # a revoked viewer must lose access on every worker at once
 
-    if from_user_id not in permission:
+    if not result.rowcount:
         raise HTTPException(404, f"{User(from_user_id)} not in {to_bearer.user}'s permission list")
+    return f"remove {User(from_user_id)} from {to_bearer.user}'s permission list successfully"
 
-    to_user_item = to_bearer.user.item
-    with Session(engine) as session:
-        permissions = permission.split()
-        permissions.remove(from_user_id)
-        to_user_item.permission = " ".join(permissions)
-        session.add(to_user_item)
-        session.commit()
-        return f"remove {User(from_user_id)} from {to_bearer.user}'s permission list successfully"
+
+@router.get("/permission/batch", response_model=dict[str, bool])
+def check_permissions(ids: list[str] = Query(max_items=100, description="数据所有者的id，可重复传多个"),
+                      bearer: Bearer = Depends()):
+    """当前用户能否查看每个id的数据，自己对自己总是`true`"""
+    permitted = permitted_by(bearer.id, ids)
+    return {owner_id: owner_id in permitted for owner_id in ids}
 
 
 @router.get("/test_permission", deprecated=True)
 def verify_permitted(from_user_id, to_user_id):
     if from_user_id == to_user_id:
         return True
-    if from_user_id not in User(to_user_id).permissions:
+    if from_user_id not in permitted_viewers(to_user_id):
         raise HTTPException(403, f"{User(from_user_id)} don't have permission to view {User(to_user_id)}'s information")
     return True
 
@@ -161,13 +293,25 @@ class ResetPwd(BaseModel):
     new_pwd: str
 
 
+def load_existence(id: str) -> bool:
+    with Session(engine) as session:
+        return session.exec(select(UserItem.id).where(UserItem.id == id)).first() is not None
+
+
+existence = ExistenceCache(load_existence, users_cache)
+existence.on_invalidate(drop_permitted)
+existence.on_invalidate(forget_tokens)
+
+
 @router.get("/user")
-@ttl_cache(1234, 5)
-def exist(id: str):
-    try:
-        return User(id).item.id == id
-    except NoResultFound:
-        return False
+def exist(id: str) -> bool:
+    return existence(id)
+
+
+@router.get("/exist_stats", tags=["dev"])
+def get_exist_stats():
+    """hits of the in-process and redis tiers of the user existence cache vs. database loads"""
+    return existence.report()
 
 
 @router.put("/user")
@@ -180,6 +324,7 @@ async def register(data: UserPut):
         session.add(user)
         session.commit()
         session.refresh(user)  # maybe redundant
+    existence.invalidate(data.id, True)
 
     return ORJSONResponse({"id": user.id}, 201)
 
@@ -210,32 +355,92 @@ async def reset_pwd(form: ResetPwd, bearer: Bearer = Depends()):
         return PlainTextResponse("wrong password", status_code=401)
 
 
-@router.delete("/user")
-async def erase(bearer: Bearer = Depends()):
-    id = bearer.id
-    if not exist(id):
-        return PlainTextResponse(f"user {id} doesn't exist", 404)
-
+def dependent_rows(id: str):
+    """set-based filters over every table referencing `id`, in the order they must be deleted"""
     from .relation import RelationItem
-    from core.userdata.favorite import FavoriteItem
+    from ..userdata.favorite import FavoriteItem
     from ..userdata.activity import ActivityItem
+    from ..userdata.reminder import ReminderItem
+
+    return [
+        (PermissionItem, or_(PermissionItem.grantor_id == id, PermissionItem.grantee_id == id)),
+        (RelationItem, or_(RelationItem.from_user_id == id, RelationItem.to_user_id == id)),
+        (FavoriteItem, FavoriteItem.user_id == id),
+        (ActivityItem, or_(ActivityItem.user_id == id, ActivityItem.creator == id)),
+        (ReminderItem, or_(ReminderItem.user_id == id, ReminderItem.creator == id)),
+    ]
 
+
+def count_dependent_rows(id: str) -> int:
     with Session(engine) as session:
-        for item in chain(
-                session.exec(select(RelationItem).where(
-                    or_(RelationItem.from_user_id == id, RelationItem.to_user_id == id)
-                )),
-                session.exec(select(FavoriteItem).where(FavoriteItem.user_id == id)),
-                session.exec(select(ActivityItem).where(ActivityItem.user_id == id))
-        ):
-            session.delete(item)
-        session.commit()
-        session.delete(User(id).item)
+        return sum(session.exec(select(func.count()).select_from(model).where(where)).one()
+                   for model, where in dependent_rows(id))
+
+
+def erase_user(id: str):
+    with Session(engine) as session:  # one transaction, a failure leaves the account untouched
+        for model, where in dependent_rows(id):
+            session.exec(delete(model).where(where))
+        session.exec(delete(UserItem).where(UserItem.id == id))
         session.commit()
+    User(id).forget()
+    existence.invalidate(id, False)  # also forgets its tokens
+    with permitted_lock:
+        permitted_cache.clear()  # it was also a grantee of others
+
+
+max_inline_erasure = 2000  # dependent rows, bigger accounts are erased in background
+erasures = set()  # running background erasures, referenced until done
+
+
+def erasure_key(id: str):
+    return f"users:erasure:{id}"
 
+
+def set_erasure_status(id: str, status: str, detail: str | None = None):
+    users_cache.hset(erasure_key(id), mapping={"status": status, "detail": detail or ""})
+    users_cache.expire(erasure_key(id), 86400)
+
+
+async def erase_in_background(id: str):
+    set_erasure_status(id, "running")
+    try:
+        await asyncio.to_thread(erase_user, id)
+    except Exception as err:
+        print(f"failed to erase user {id}: {err!r}")
+        set_erasure_status(id, "failed", f"{type(err).__name__}: {err}")
+    else:
+        set_erasure_status(id, "done")
+
+
+@router.delete("/user", responses={202: {"description": "数据较多，已转入后台删除，用`GET /user/erasure`查看进度"}})
+async def erase(bearer: Bearer = Depends()):
+    id = bearer.id
+    if not exist(id):
+        return PlainTextResponse(f"user {id} doesn't exist", 404)
+
+    if (rows := count_dependent_rows(id)) > max_inline_erasure:
+        erasures.add(task := asyncio.create_task(erase_in_background(id)))
+        task.add_done_callback(erasures.discard)
+        return ORJSONResponse({"status": "running", "rows": rows}, 202)
+
+    erase_user(id)
     return not exist(id)
 
 
+class ErasureStatus(BaseModel):
+    status: str = Field(title="状态", description="running / done / failed，没有后台删除过则为 none")
+    detail: str | None = Field(title="失败原因")
+
+
+@router.get("/user/erasure", response_model=ErasureStatus)
+def get_erasure_status(bearer: Bearer = Depends()):
+    """后台删除账号的进度，账号删除后原来的token仍可查询"""
+    if not (status := users_cache.hgetall(erasure_key(bearer.id))):
+        return {"status": "none"}
+    return {"status": status[b"status"].decode(), "detail": status[b"detail"].decode() or None}
+
+
 @router.get("/avatar/{id}")
 async def get_avatar(id: str):
     """获取用户头像"""
@@ -275,6 +480,35 @@ async def set_bio(bio: str, bearer: Bearer = Depends()):
     return bio
 
 
+class ProfilePatch(BaseModel):
+    name: str | None = Field(title="昵称")
+    avatar: str | None = Field(title="头像链接")
+    bio: str | None = Field(title="个性签名")
+    location: tuple[float, float] | None = Field(title="位置", description="经度, 纬度")
+
+
+class Profile(BaseModel):
+    name: str | None = Field(title="昵称")
+    avatar: str | None = Field(title="头像链接")
+
+
+@router.patch("/profile")
+def update_profile(data: ProfilePatch, bearer: Bearer = Depends()):
+    """一次修改昵称、头像、签名、位置中的任意几项，只传要改的；返回修改后的全部资料"""
+    changes = data.dict(exclude_unset=True)
+    if (location := changes.get("location")) is not None:
+        changes["location"] = str(list(location))  # the format `GET /geo` reads
+    return bearer.user.update_meta(changes)
+
+
+@router.get("/profile/batch", response_model=dict[str, Profile])
+def get_profiles(ids: list[str] = Query(max_items=100, description="用户id，可重复传多个")):
+    """一次获取多个用户的昵称和头像，不存在的用户不会出现在结果里"""
+    with Session(engine) as session:
+        rows = session.exec(select(UserItem.id, UserItem.meta).where(UserItem.id.in_(set(ids)))).all()
+    return {id: loads(meta) for id, meta in rows}
+
+
 @router.get("/geo")
 async def get_location(id: str = None, bearer: Bearer = Depends()):
     if id is not None:
@@ -2,6 +2,8 @@ from .impl import *
 from sqlmodel import Field as DbField
 from ..common.secret import pool
 from random import randrange
+from collections import Counter
+from time import time
 from pydantic import Field
 from redis import Redis
 
@@ -26,7 +28,25 @@ class RelationItem(SQLModel, table=True):
 
     @property
     def permitted(self):
-        return self.from_user_id in User(self.to_user_id).permissions
+        return self.from_user_id == self.to_user_id or self.from_user_id in permitted_viewers(self.to_user_id)
+
+
+def relatives_where(condition) -> list[dict]:
+    """relations matching `condition` with whether `to_user_id` permitted `from_user_id`, in one joined query"""
+    with Session(engine) as session:
+        rows = session.exec(
+            select(RelationItem, PermissionItem.grantee_id)
+            .outerjoin(PermissionItem, (PermissionItem.grantor_id == RelationItem.to_user_id) &
+                       (PermissionItem.grantee_id == RelationItem.from_user_id))
+            .where(condition)
+        ).all()
+    return [{
+        "from_user_id": item.from_user_id,
+        "to_user_id": item.to_user_id,
+        "relation": item.relation,
+        "permitted": grantee_id is not None or item.from_user_id == item.to_user_id,
+        "id": item.id
+    } for item, grantee_id in rows]
 
 
 class RelativePost(BaseModel):
@@ -63,17 +83,7 @@ class RelativeRes(RelativePost):
 async def get_relatives(id: str = None, bearer: Bearer = Depends()):
     from_user_id = bearer.id if id is None else ensure(id)
     bearer.ensure_been_permitted_by(from_user_id)
-    with Session(engine) as session:
-        return [
-            {
-                "from_user_id": from_user_id,
-                "to_user_id": item.to_user_id,
-                "relation": item.relation,
-                "permitted": from_user_id in User(item.to_user_id).permissions,
-                "id": item.id
-            }
-            for item in session.exec(select(RelationItem).where(RelationItem.from_user_id == from_user_id))
-        ]
+    return relatives_where(RelationItem.from_user_id == from_user_id)
 
 
 @router.get("/refs", response_model=list[RelativeRes])
@@ -84,11 +94,7 @@ async def get_ones_references(id: str = None, bearer: Bearer = Depends()):
     """
     to_user_id = bearer.id if id is None else ensure(id)
     bearer.ensure_been_permitted_by(to_user_id)
-    with Session(engine) as session:
-        return [
-            RelativeRes(**item.dict(), permitted=item.permitted)
-            for item in session.exec(select(RelationItem).where(RelationItem.to_user_id == to_user_id))
-        ]
+    return relatives_where(RelationItem.to_user_id == to_user_id)
 
 
 class RelativePatch(BaseModel):
@@ -126,18 +132,104 @@ async def delete_relative(id: int, bearer: Bearer = Depends()):
     return f"delete {id} successfully"
 
 
-@router.post("/match", response_model=str, response_class=PlainTextResponse)
-def generate_sequence(n: int = 4, bearer: Bearer = Depends(), expire: int = 60):
-    count = 0
-    while (sequence := "".join([str(randrange(10)) for _ in range(n)])) in match_cache:
-        count += 1
-        if count > 1234:
-            raise HTTPException(508, f"time out, maybe run out of all possibilities of {n}-digit combinations")
+# KEYS: live codes zset, free pool set, pooled marker, candidate codes
+# ARGV: user id, ttl, now, digits, whether a pool may be built, utilisation above which it's built
+# codes whose ttl passed are pruned, or go back to the pool once there is one. the pool is built here
+# when utilisation crosses the threshold, and the marker keeps the mode even while the pool set is empty
+allocate_code = match_cache.register_script("""
+local live, free, marker = KEYS[1], KEYS[2], KEYS[3]
+local now, digits = tonumber(ARGV[3]), tonumber(ARGV[4])
+local function add_free(codes)
+    for i = 1, #codes, 1000 do
+        redis.call("SADD", free, unpack(codes, i, math.min(i + 999, #codes)))
+    end
+end
+local pooled = redis.call("EXISTS", marker) == 1
+local expired = redis.call("ZRANGEBYSCORE", live, "-inf", now)
+if #expired > 0 then
+    redis.call("ZREMRANGEBYSCORE", live, "-inf", now)
+    if pooled then add_free(expired) end
+end
+if not pooled and ARGV[5] == "1" and redis.call("ZCARD", live) > tonumber(ARGV[6]) * 10 ^ digits then
+    local codes = {}
+    for i = 0, 10 ^ digits - 1 do
+        local code = string.format("%0" .. digits .. "d", i)
+        if not redis.call("ZSCORE", live, code) then codes[#codes + 1] = code end
+    end
+    add_free(codes)
+    redis.call("SET", marker, 1)
+    pooled = true
+end
+local function take(code)
+    if redis.call("SET", code, ARGV[1], "NX", "EX", ARGV[2]) then
+        redis.call("ZADD", live, now + ARGV[2], code)
+        return true
+    end
+end
+if pooled then
+    for _ = 1, 16 do
+        local code = redis.call("SPOP", free)
+        if not code then break end
+        if take(code) then return {code, 1} end
+    end
+    return {false, 1}
+end
+for i = 4, #KEYS do
+    if take(KEYS[i]) then return {KEYS[i], 0} end
+end
+return {false, 0}
+""")
+
+pool_threshold = 0.5  # utilisation above which codes are drawn from the free pool instead of guessed
+max_pooled_digits = 5  # a pool holds every free code, 10^5 members at most
+candidates_per_call = 8
+match_stats = Counter(allocations=0, pooled_allocations=0, exhausted=0)
+
+
+def live_key(n: int):
+    return f"match:live:{n}"
+
+
+def free_key(n: int):
+    return f"match:free:{n}"
+
+
+def pooled_key(n: int):
+    return f"match:pooled:{n}"
+
+
+def utilisation(n: int) -> float:
+    return match_cache.zcount(live_key(n), time(), "+inf") / 10 ** n  # expired ones are pruned by `allocate_code`
 
-    match_cache[sequence] = bearer.id
-    match_cache.set(sequence, bearer.id, expire)
 
-    return sequence
+@router.post("/match", response_model=str, response_class=PlainTextResponse)
+def generate_sequence(n: int = Query(4, ge=1, le=8), bearer: Bearer = Depends(), expire: int = Query(60, gt=0)):
+    candidates = ["".join([str(randrange(10)) for _ in range(n)]) for _ in range(candidates_per_call)]
+    sequence, pooled = allocate_code(
+        keys=[live_key(n), free_key(n), pooled_key(n), *candidates],
+        args=[bearer.id, expire, time(), n, int(n <= max_pooled_digits), pool_threshold]
+    )
+    if not sequence:
+        match_stats["exhausted"] += 1
+        raise HTTPException(508, f"time out, maybe run out of all possibilities of {n}-digit combinations")
+
+    match_stats["allocations"] += 1
+    match_stats["pooled_allocations"] += pooled
+    return sequence.decode()
+
+
+@router.get("/match/stats", tags=["dev"])
+def get_match_stats():
+    """how full each code length is across all workers, and this worker's allocations"""
+    lengths = sorted(int(key.decode().rsplit(":", 1)[1]) for key in match_cache.scan_iter("match:live:*"))
+    return {
+        "codes": {n: {
+            "live": match_cache.zcount(live_key(n), time(), "+inf"), "capacity": 10 ** n,
+            "utilisation": round(utilisation(n), 4),
+            "pooled": match_cache.scard(free_key(n)) if match_cache.exists(pooled_key(n)) else None
+        } for n in lengths},
+        "worker": match_stats
+    }
 
 
 @router.get("/match", response_model=str, response_class=PlainTextResponse)
@@ -6,6 +6,8 @@ from pydantic import BaseModel, Field
 from ..common.auth import Bearer
 from ..common.sql import engine
 from ..user.impl import ensure
+from sqlalchemy import Index
+from .paging import Page
 from enum import Enum
 
 router = APIRouter(tags=["activity"])
@@ -20,6 +22,7 @@ class Progress(Enum):
 
 class ActivityItem(SQLModel, table=True):
     __tablename__ = "activities"
+    __table_args__ = (Index("ix_activities_user_id_id", "user_id", "id"),)
     id: int | None = DbField(default=None, primary_key=True)
     user_id: str = DbField(foreign_key="users.id")
     creator: str = DbField(foreign_key="users.id")
@@ -42,14 +45,17 @@ class ActivityItem(SQLModel, table=True):
 
 
 @router.get("/activity")
-def get_activities(bearer: Bearer = Depends(), user_id: str | None = Query(None, title="列出谁的活动", example="id")):
+def get_activities(bearer: Bearer = Depends(), user_id: str | None = Query(None, title="列出谁的活动", example="id"),
+                   page: Page = Depends()):
     """获取活动。获取亲友的活动暂时只能分别去获取"""
     if user_id is None:
         user_id = bearer.id
     else:
         bearer.ensure_been_permitted_by(ensure(user_id))
     with Session(engine) as session:
-        return session.exec(select(ActivityItem).where(ActivityItem.user_id == user_id)).all()
+        return page.cut(session.exec(page.apply(
+            select(ActivityItem).where(ActivityItem.user_id == user_id), ActivityItem.id
+        )).all())
 
 
 class ActivityPut(BaseModel):
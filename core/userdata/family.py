@@ -0,0 +1,66 @@
+from sqlmodel import SQLModel, select, Session, func
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy.orm import aliased
+from pydantic import BaseModel, Field
+from ..user.impl import UserItem, permitted_by
+from ..user.relation import RelationItem
+from .activity import ActivityItem, Progress
+from .reminder import ReminderItem
+from ..common.auth import Bearer
+from ..common.sql import engine
+from datetime import datetime
+from ujson import loads
+
+router = APIRouter(tags=["family"])
+
+
+def first_per_user(model: type[SQLModel], condition, order_by, limit: int):
+    """rows of `model` matching `condition`, at most `limit` per `user_id` in `order_by` order, in one query"""
+    rank = func.row_number().over(partition_by=model.user_id, order_by=order_by).label("rank")
+    ranked = select(model, rank).where(condition).subquery()
+    return select(aliased(model, ranked)).where(ranked.c.rank <= limit).order_by(ranked.c.user_id, ranked.c.rank)
+
+
+class RelativeOverview(BaseModel):
+    user_id: str = Field(alias="userId", title="亲友id")
+    relations: list[str] = Field(title="关系", description="和亲友可以有多重关系")
+    name: str | None = Field(title="昵称")
+    avatar: str | None = Field(title="头像链接")
+    reminders: list[ReminderItem] = Field(title="即将到来的备忘", description="按提醒时间从近到远")
+    activities: list[dict] = Field(title="进行中的活动", description="按开始时间从早到晚，每项和`GET /activity`的相同")
+
+
+@router.get("/family/overview", response_model=list[RelativeOverview])
+def get_family_overview(bearer: Bearer = Depends(),
+                        reminders: int = Query(5, ge=0, le=50, title="每位亲友最多几条备忘"),
+                        activities: int = Query(5, ge=0, le=50, title="每位亲友最多几个活动")):
+    """## 亲友总览
+
+    列出我添加的、且允许我查看的每位亲友，附带他们即将到来的备忘和进行中的活动，代替对每位亲友分别请求`/reminder`和`/activity`
+    """
+    with Session(engine) as session:
+        relations = {}
+        for to_user_id, relation in session.exec(
+                select(RelationItem.to_user_id, RelationItem.relation).where(RelationItem.from_user_id == bearer.id)
+        ):
+            relations.setdefault(to_user_id, []).append(relation)
+        if not (ids := permitted_by(bearer.id, relations)):
+            return []
+
+        overview = {id: {"userId": id, "relations": relations[id], "reminders": [], "activities": []} for id in ids}
+        for id, meta in session.exec(select(UserItem.id, UserItem.meta).where(UserItem.id.in_(ids))):
+            overview[id] |= loads(meta)
+        if reminders:
+            for item in session.exec(first_per_user(
+                    ReminderItem, ReminderItem.user_id.in_(ids) & (ReminderItem.notification_time >= datetime.utcnow()),
+                    ReminderItem.notification_time, reminders
+            )):
+                overview[item.user_id]["reminders"].append(item)
+        if activities:
+            for item in session.exec(first_per_user(
+                    ActivityItem, ActivityItem.user_id.in_(ids) & (ActivityItem.situation == Progress.doing),
+                    ActivityItem.start_time, activities
+            )):
+                overview[item.user_id]["activities"].append(item.dict(by_alias=True))
+
+    return [overview[id] for id in relations if id in overview]
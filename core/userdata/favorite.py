@@ -1,13 +1,18 @@
-from ..info.news import get_article_info, ArticleDetails
+from ..info.news import ArticleDetails, article_store, get_bounded, formatted
+from ..info.compact import HtmlFormat, html_format
+from ..info.store import ArticleItem
 from sqlmodel import SQLModel, Field, select, Session
 from starlette.exceptions import HTTPException
 from datetime import datetime, timezone
-from fastapi import Depends, APIRouter
+from fastapi import Depends, APIRouter, Query
 from ..common.auth import Bearer
 from urllib.parse import urljoin
 from ..common.sql import engine
 from ..user.impl import ensure
 from pydantic import BaseModel
+from sqlalchemy import Index
+from .paging import Page
+import asyncio
 
 router = APIRouter(tags=["favorite"])
 
@@ -57,28 +62,39 @@ async def get_meta(url):
 
 class FavoriteItem(SQLModel, table=True):
     __tablename__ = "favorites"
+    __table_args__ = (Index("ix_favorites_user_id_id", "user_id", "id"),)
     id: int | None = Field(default=None, primary_key=True)
     user_id: str = Field(foreign_key="users.id")
     time_stamp: datetime = Field(default_factory=lambda: datetime.utcnow().replace(tzinfo=timezone.utc))
     article_id: int = Field(title="文章唯一标识")
+    title: str | None = Field(None, title="收藏时的文章标题")
+    date: str | None = Field(None, max_length=10, title="收藏时的文章发布日期")
 
 
 class FavoriteResponse(BaseModel):
     id: int
     timeStamp: datetime
     articleId: int
+    title: str | None
+    date: str | None
     details: ArticleDetails | None
 
 
-async def get_article_details(article_id: int) -> ArticleDetails | None:
+async def get_article_details(article_id: int, format: HtmlFormat) -> ArticleDetails | None:
     try:
-        return await get_article_info(article_id)
+        return formatted(await get_bounded(article_id), format)
     except HTTPException:
         return None
 
 
 @router.get("/favorite", response_model=list[FavoriteResponse])
-async def get_favorites(bearer: Bearer = Depends(), user_id: str = None):
+async def get_favorites(bearer: Bearer = Depends(), user_id: str = None,
+                        snapshot: bool = Query(False, description="只返回收藏时记下的标题和日期，不获取文章详情"),
+                        format: HtmlFormat = Depends(html_format), page: Page = Depends()):
+    """## 获取收藏
+
+    文章详情优先从本地文章库读取，缺的并发去抓取；`snapshot`时完全不抓取，`details`为空
+    """
     if user_id is None:
         owner = bearer.id
     else:
@@ -86,15 +102,34 @@ async def get_favorites(bearer: Bearer = Depends(), user_id: str = None):
         bearer.ensure_been_permitted_by(owner)
 
     with Session(engine) as session:
-        return [
-            {
-                "id": item.id,
-                "timeStamp": item.time_stamp,
-                "articleId": item.article_id,
-                "details": await get_article_details(article_id=item.article_id)
-            }
-            for item in session.exec(select(FavoriteItem).where(FavoriteItem.user_id == owner))
-        ]
+        items = page.cut(session.exec(page.apply(
+            select(FavoriteItem).where(FavoriteItem.user_id == owner), FavoriteItem.id
+        )).all())
+        # favorites added before snapshots existed fall back to the crawled article list
+        if missing := {item.article_id for item in items if item.title is None}:
+            mirrored = {article.article_id: article for article in session.exec(
+                select(ArticleItem).where(ArticleItem.article_id.in_(missing))
+            )}
+            for item in items:
+                if item.title is None and (article := mirrored.get(item.article_id)) is not None:
+                    item.title, item.date = article.title, article.date
+
+    if snapshot:
+        details = [None] * len(items)
+    else:
+        details = await asyncio.gather(*(get_article_details(item.article_id, format) for item in items))
+
+    return [
+        {
+            "id": item.id,
+            "timeStamp": item.time_stamp,
+            "articleId": item.article_id,
+            "title": item.title,
+            "date": item.date,
+            "details": article_details
+        }
+        for item, article_details in zip(items, details)
+    ]
 
 
 class FavoriteForm(BaseModel):
@@ -102,6 +137,19 @@ class FavoriteForm(BaseModel):
     article_id: int = Field(alias="articleId")
 
 
+def snapshot_of(article_id: int) -> tuple[str | None, str | None]:
+    """title and date from local data only, the favorite is saved without them rather than waiting on upstream"""
+    try:
+        if (hit := article_store.lookup(article_id)) is not None:  # usually just viewed, so a store hit
+            return hit[1].title, hit[1].datetime.split()[0]
+        with Session(engine) as session:
+            if (article := session.get(ArticleItem, article_id)) is not None:
+                return article.title, article.date
+    except Exception as err:
+        print(f"failed to snapshot article {article_id}: {err!r}")
+    return None, None
+
+
 @router.post("/favorite", response_model=FavoriteItem)
 def add_favorite(data: FavoriteForm, bearer: Bearer = Depends()):
     if data.user_id is None:
@@ -110,8 +158,10 @@ def add_favorite(data: FavoriteForm, bearer: Bearer = Depends()):
         owner = ensure(data.user_id)
         bearer.ensure_been_permitted_by(owner)
 
+    title, date = snapshot_of(data.article_id)
+
     with Session(engine) as session:
-        session.add(item := FavoriteItem(user_id=owner, article_id=data.article_id))
+        session.add(item := FavoriteItem(user_id=owner, article_id=data.article_id, title=title, date=date))
         session.commit()
         session.refresh(item)
 
@@ -0,0 +1,29 @@
+from fastapi import Query, Response
+
+
+class Page:
+    """keyset pagination over an autoincrement id, stable however many rows are added or removed meanwhile
+
+    pass the `X-Next-Cursor` response header as `after` to get the next page, it's absent on the last page
+    """
+
+    def __init__(self, response: Response,
+                 after: int | None = Query(None, title="游标", description="上一页响应头`X-Next-Cursor`的值，不填则从头开始"),
+                 limit: int = Query(100, ge=1, le=500, title="每页条数"),
+                 reverse: bool = Query(False, title="是否倒序", description="按创建先后，默认从旧到新")):
+        self.response = response
+        self.after = after
+        self.limit = limit
+        self.reverse = reverse
+
+    def apply(self, statement, id_column):
+        if self.after is not None:
+            statement = statement.where(id_column < self.after if self.reverse else id_column > self.after)
+        # one extra row tells whether there is a next page
+        return statement.order_by(id_column.desc() if self.reverse else id_column).limit(self.limit + 1)
+
+    def cut(self, items: list):
+        if len(items) > self.limit:
+            items = items[:self.limit]
+            self.response.headers["X-Next-Cursor"] = str(items[-1].id)
+        return items
@@ -1,11 +1,13 @@
 from sqlmodel import SQLModel, Field as DbField, select, Session
 from starlette.exceptions import HTTPException
 from datetime import datetime, timezone
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Query
 from pydantic import BaseModel, Field
 from ..common.auth import Bearer
 from ..common.sql import engine
 from ..user.impl import ensure
+from sqlalchemy import Index
+from .paging import Page
 
 router = APIRouter(tags=["reminder"])
 
@@ -16,6 +18,10 @@ def get_current_datetime_utc():
 
 class ReminderItem(SQLModel, table=True):
     __tablename__ = "reminders"
+    __table_args__ = (
+        Index("ix_reminders_user_id_id", "user_id", "id"),
+        Index("ix_reminders_user_id_notification_time", "user_id", "notification_time"),
+    )
     id: int | None = DbField(default=None, primary_key=True)
     user_id: str = DbField(foreign_key="users.id")
     creator: str = DbField(foreign_key="users.id")
@@ -35,13 +41,21 @@ class ReminderItem(SQLModel, table=True):
 
 
 @router.get("/reminder", response_model=list[ReminderItem])
-def get_reminders(bearer: Bearer = Depends(), user_id: str = None):
+def get_reminders(bearer: Bearer = Depends(), user_id: str = None, page: Page = Depends(),
+                  notify_from: datetime | None = Query(None, title="提醒时间不早于", description="例如只看当日的备忘"),
+                  notify_to: datetime | None = Query(None, title="提醒时间早于")):
     if user_id is None:
         user_id = bearer.id
     else:
         bearer.ensure_been_permitted_by(ensure(user_id))
+
+    statement = select(ReminderItem).where(ReminderItem.user_id == user_id)
+    if notify_from is not None:
+        statement = statement.where(ReminderItem.notification_time >= notify_from)
+    if notify_to is not None:
+        statement = statement.where(ReminderItem.notification_time < notify_to)
     with Session(engine) as session:
-        return session.exec(select(ReminderItem).where(ReminderItem.user_id == user_id)).all()
+        return page.cut(session.exec(page.apply(statement, ReminderItem.id)).all())
 
 
 class ReminderPut(BaseModel):
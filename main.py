@@ -1,26 +1,57 @@
 from fastapi.openapi.docs import get_redoc_html, get_swagger_ui_html
 from starlette.responses import RedirectResponse, HTMLResponse
-from core.userdata import activity, reminder, favorite
+from contextlib import asynccontextmanager
+from core.userdata import activity, reminder, favorite, family
 from core.common.sql import create_db_and_tables
+from core.common.leader import leaders
+from core.common.disk_cache import image_cache
 from starlette.templating import Jinja2Templates
 from starlette.staticfiles import StaticFiles
 from fastapi.responses import ORJSONResponse
 from sqlalchemy.exc import OperationalError
 from core.user import router, dev_router
+from core.user.impl import IdentityMapMiddleware, migrate_permissions, existence
 from brotli_asgi import BrotliMiddleware
 from starlette.requests import Request
 from fastapi import FastAPI, Depends
 from core.common.secret import host
 from core.common.auth import Bearer
 from core.user import relation
-from httpx import AsyncClient
+from core.common import http
 from core import card, info
 from os import system
+import asyncio
 
-create_db_and_tables()
+with leaders.lock("db:migrate", timeout=300):  # workers start together, one at a time alters tables and copies rows
+    create_db_and_tables()
+    migrate_permissions()
 
 version = "0.4.12"
 
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    if not info.search.index.docs:
+        info.search.rebuild_index()
+    autosave = asyncio.create_task(info.search.index.autosave())
+    prewarm = asyncio.create_task(http.prewarm())
+    refresh_grid = asyncio.create_task(info.catalog.refresh_grid())
+    existence.start()
+    info.crawler.article_crawler.start()
+    info.regions.region_tree.start()
+    info.catalog.geocoder.start()
+    yield
+    await info.crawler.article_crawler.stop()
+    await info.regions.region_tree.stop()
+    await info.catalog.geocoder.stop()
+    existence.stop()
+    prewarm.cancel()
+    refresh_grid.cancel()
+    await http.aclose_all()
+    autosave.cancel()
+    image_cache.save()
+
+
 app = FastAPI(title="守护青松 Guard Pine", version=version,
               license_info={"name": "MIT License", "url": "https://mit-license.org/"},
               contact={"name": "Muspi Merol", "url": "https://muspimerol.site/", "email": "admin@muspimerol.site"},
@@ -32,12 +63,14 @@ app = FastAPI(title="守护青松 Guard Pine", version=version,
                   {"name": "activity", "description": "活动增删查改"},
                   {"name": "favorite", "description": "收藏增删查改"},
                   {"name": "relation", "description": "关系增删查改"},
+                  {"name": "family", "description": "亲友的备忘和活动总览"},
                   {"name": "card", "description": "首页卡片 **fake info**"}
               ],
               # description=open("./readme.md", encoding="utf-8").read(),
               description="### “守护青松”国家级大创项目 [部署地址](https://gp.muspimerol.site/)",
-              docs_url=None, redoc_url=None, default_response_class=ORJSONResponse)
+              docs_url=None, redoc_url=None, default_response_class=ORJSONResponse, lifespan=lifespan)
 app.add_middleware(BrotliMiddleware, quality=11, minimum_size=256)
+app.add_middleware(IdentityMapMiddleware)
 
 
 @app.middleware("http")
@@ -80,12 +113,9 @@ def git_pull():
     return RedirectResponse("/docs")
 
 
-client = AsyncClient(http2=True)
-
-
 async def get_iframe(url, title=None) -> bytes:
     # noinspection HttpUrlsUsage
-    return (await client.get(f"http://{host}/link", params={"url": url, "title": title})).content
+    return (await http.default.get(f"http://{host}/link", params={"url": url, "title": title})).content
 
 
 @app.get("/docs", include_in_schema=False)
@@ -115,6 +145,7 @@ app.include_router(reminder.router)
 app.include_router(relation.router)
 app.include_router(activity.router)
 app.include_router(favorite.router)
+app.include_router(family.router)
 app.include_router(card.router)
 app.include_router(info.router)
 app.mount("/static", StaticFiles(directory="static"))
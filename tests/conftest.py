@@ -0,0 +1,14 @@
+"""a throwaway `core.common.secret`: a sqlite file instead of mysql and an in-memory fake redis"""
+
+from tempfile import mkdtemp
+from types import ModuleType
+from pathlib import Path
+import fakeredis
+import sys
+
+secret = ModuleType("core.common.secret")
+secret.database_url = f"sqlite:///{(Path(mkdtemp()) / 'gp.db').as_posix()}"
+secret.app_id = secret.app_id_0 = secret.app_id_1 = "app id"
+secret.app_secret = secret.app_secret_0 = secret.app_secret_1 = "app secret used to sign test tokens only"
+secret.pool = fakeredis.FakeRedis().connection_pool
+sys.modules["core.common.secret"] = secret  # never the real one, the tests empty tables
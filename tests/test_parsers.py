@@ -0,0 +1,17 @@
+from bench.parsers import page_types, fixture_path
+from bs4 import BeautifulSoup
+import pytest
+
+fixtures = [(page_type, path) for page_type, (paths, _, _) in page_types.items()
+            for path in paths if fixture_path(page_type, path).is_file()]
+
+
+@pytest.mark.parametrize("page_type,path", fixtures)
+def test_strained_parse_extracts_the_same(page_type: str, path: str):
+    _, extract, strainer = page_types[page_type]
+    page = fixture_path(page_type, path).read_text("utf-8")
+    assert extract(BeautifulSoup(page, "lxml", parse_only=strainer)) == extract(BeautifulSoup(page, "lxml"))
+
+
+def test_every_page_type_has_a_fixture():
+    assert {page_type for page_type, _ in fixtures} == set(page_types)
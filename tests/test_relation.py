@@ -0,0 +1,70 @@
+from core.user.impl import UserItem, PermissionItem, IdentityMapMiddleware
+from core.user.relation import RelationItem, router
+from core.common.sql import engine, create_db_and_tables
+from core.common.secret import app_secret_1
+from fastapi.testclient import TestClient
+from sqlmodel import Session, delete
+from contextlib import contextmanager
+from sqlalchemy import event
+from fastapi import FastAPI
+import pytest
+import jwt
+
+app = FastAPI()
+app.add_middleware(IdentityMapMiddleware)
+app.include_router(router)
+
+
+def headers(user_id: str):
+    return {"authorization": f"Bearer {jwt.encode({'id': user_id}, app_secret_1, 'HS256')}"}
+
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+@pytest.fixture(scope="module")
+def client():
+    create_db_and_tables()
+    relatives = [f"relative{i}" for i in range(10)]
+    with Session(engine) as session:
+        for model in (RelationItem, PermissionItem, UserItem):
+            session.exec(delete(model))
+        for user_id in ["me", *relatives]:
+            session.add(UserItem(id=user_id, pwd_hash=b""))
+        session.commit()  # sqlite doesn't order the inserts of different tables by their foreign keys
+        for i, user_id in enumerate(relatives):
+            session.add(RelationItem(from_user_id="me", to_user_id=user_id, relation="亲戚"))
+            session.add(RelationItem(from_user_id=user_id, to_user_id="me", relation="亲戚"))
+            if i % 2:
+                session.add(PermissionItem(grantor_id=user_id, grantee_id="me"))
+        session.add(PermissionItem(grantor_id="me", grantee_id="relative0"))
+        session.commit()
+    with TestClient(app) as client:
+        yield client
+
+
+def test_relatives_in_one_query(client):
+    with count_queries() as statements:
+        relatives = client.get("/relative", headers=headers("me")).json()
+    assert len(statements) == 1
+    assert len(relatives) == 10
+    assert {item["to_user_id"] for item in relatives if item["permitted"]} == {f"relative{i}" for i in range(1, 10, 2)}
+
+
+def test_refs_in_one_query(client):
+    with count_queries() as statements:
+        refs = client.get("/refs", headers=headers("me")).json()
+    assert len(statements) == 1
+    assert len(refs) == 10
+    assert [item["from_user_id"] for item in refs if item["permitted"]] == ["relative0"]